@@ -9,6 +9,7 @@ import matplotlib.pyplot as pl
 from ing_theme_matplotlib import mpl_style
 from common import *
 from rng import generate_lognormal_numbers
+from swap_index import SwapSizeIndex
 
 pl.rcParams["savefig.dpi"] = 200
 
@@ -35,20 +36,13 @@ def plot_max_size():
 
 
 
-def get_volume(swap_sizes, max_size):
-    return np.sum(swap_sizes[swap_sizes < max_size])
-
-def get_num_tx(swap_sizes, max_size):
-    return np.sum(swap_sizes < max_size)
-
-
-def plot_volume(swap_sizes):
+def plot_volume(swap_index):
     logliq = np.linspace(MIN_LIQUIDITY_EXPONENT_USD, MAX_LIQUIDITY_EXPONENT_USD, 100)
     liq = [10 ** u for u in logliq]
     pl.figure(figsize=(5, 3.5))
     for max_price_impact_pct in TESTED_PRICE_IMPACTS_PCT:
         max_size = [swap_size_from_liquidity(u, max_price_impact_pct / 100) for u in liq]
-        pl.plot(liq, [get_volume(swap_sizes, size) for size in max_size],
+        pl.plot(liq, swap_index.volume_below(max_size),
                 label=f"Requires price impact ≤{max_price_impact_pct:.2f}%")
 
     pl.xlabel('Liquidity, $')
@@ -60,14 +54,14 @@ def plot_volume(swap_sizes):
     pl.close()
 
 
-def plot_num_tx(swap_sizes):
-    total = len(swap_sizes)
+def plot_num_tx(swap_index):
+    total = len(swap_index)
     logliq = np.linspace(MIN_LIQUIDITY_EXPONENT_USD, MAX_LIQUIDITY_EXPONENT_USD, 100)
     liq = [10 ** u for u in logliq]
     pl.figure(figsize=(5, 3.5))
     for max_price_impact_pct in TESTED_PRICE_IMPACTS_PCT:
         max_size = [swap_size_from_liquidity(u, max_price_impact_pct / 100) for u in liq]
-        num_tx = [get_num_tx(swap_sizes, size) for size in max_size]
+        num_tx = swap_index.count_below(max_size)
         pl.plot(liq, [(1.0 - u / total) * 100 for u in num_tx],
                 label=f"Requires price impact ≤{max_price_impact_pct:.2f}%")
 
@@ -89,8 +83,9 @@ def main():
     swap_sizes = generate_lognormal_numbers(size=1_000_000)
     print("total volume:", sum(swap_sizes) / 1e6, "M")
     plot_max_size()
-    plot_volume(swap_sizes)
-    plot_num_tx(swap_sizes)
+    swap_index = SwapSizeIndex(swap_sizes)
+    plot_volume(swap_index)
+    plot_num_tx(swap_index)
 
 
 
@@ -7,22 +7,34 @@
 import matplotlib.pyplot as pl
 import numpy as np
 from ing_theme_matplotlib import mpl_style
-from dex import DEX, POOL_FEE_PIPS
 from common import *
-from simulation import get_price_paths, estimate_performance, generate_trades
+from simulation import get_price_paths, estimate_performance
+from batch import estimate_performance_batch
+from sweep import run_sweep, SWEEP_SEED
+from trade_store import TradeStore
+from results_store import ResultStore
+from memo import Memoized, MemoizedBatch
+from recorder import Recorder
+from variance_reduction import lvr_with_fees_formula, price_weighted_variance, analytical_pnl, control_variate_mean, plain_mean
 # Constants for plotting
 pl.rcParams["savefig.dpi"] = 200
 
-############################################################
+# the same trade sets are replayed at every liquidity level
+trade_store = TradeStore()
+
+# with one pool per price path (40 paths), the scalar engine is faster than `batch.py`,
+# so the plots of single liquidity levels run one scalar simulation per path
+estimate_performance_cached = Memoized(estimate_performance)
+
+# the liquidity sweep runs `batch.py` on several levels at once: with 160 pools (4 levels x 40 paths)
+# it is 3-6x faster than the scalar simulations of the same pools, with the same results
+estimate_performance_batch_cached = MemoizedBatch(estimate_performance_batch)
+SWEEP_LEVELS_PER_TASK = 4
+
+PRICE_PATH_SEED = 123456
 
-# this is from the paper, but does not give accurate results
-def lvr_with_fees_formula():
-    sigma_per_block = ETH_VOLATILITY_PER_BLOCK
-    block_time = BLOCK_TIME_SEC
-    gamma = POOL_FEE_PIPS / 1e6
-    blocks_per_day = 86400 / block_time
-    result_per_block = (sigma_per_block ** 3) * sqrt(block_time / 2) / (8 * gamma)
-    return result_per_block * blocks_per_day
+# the results of the liquidity sweep are kept here; delete the file to simulate again
+RESULTS_FILENAME = "2_results.bin"
 
 ############################################################
 
@@ -33,29 +45,20 @@ def plot_performance_arb_only(all_prices):
     for liquidity_usd in [5e6, 1e7]:
         print("liquidity_usd=", liquidity_usd / 1e6, "M")
 
-        all_volume = []
-        all_lp_pnl = []
-
+        # record the pools' state every hour to plot the actual PnL over time
+        num_blocks = all_prices.shape[0]
+        recorder = Recorder(num_blocks, num_runs=all_prices.shape[1])
         for sim in range(all_prices.shape[1]):
-            prices = all_prices[:,sim]
-            num_blocks = len(prices)
-            lvr, lp_fees, lp_fees_arb, volume, volume_arb = \
-                estimate_performance(prices, None, liquidity_usd)
-            all_volume.append(volume)
-            lp_pnl = lp_fees - lvr
-            all_lp_pnl.append(lp_pnl)
-
-        duration_days = num_blocks * BLOCK_TIME_SEC / 86400
-        avg_total_pnl = sum(all_lp_pnl) / NUM_SIMULATIONS
+            estimate_performance(all_prices[:,sim], None, liquidity_usd, recorder=recorder.for_run(sim))
+        all_lp_pnl = recorder.field("lp_fees") - recorder.field("lvr")
+        avg_lp_pnl = all_lp_pnl.mean(axis=0)
 
         pnl_per_day_analytical = -lvr_with_fees_formula()
         pnl_per_day_analytical *= liquidity_usd
-        
-        pnl_per_day = avg_total_pnl / duration_days
 
-        x = range(int(10 * duration_days))
-        #pl.plot(x, [u * pnl_per_day_analytical for u in x], label=f"Liquidity=${liquidity_usd/1e6:.0f}M, analytical", linestyle="-")
-        pl.plot(x, [u * pnl_per_day for u in x], label=f"Liquidity=${liquidity_usd/1e6:.0f}M")
+        x = recorder.days()
+        #pl.plot(x, x * pnl_per_day_analytical, label=f"Liquidity=${liquidity_usd/1e6:.0f}M, analytical", linestyle="-")
+        pl.plot(x, avg_lp_pnl, label=f"Liquidity=${liquidity_usd/1e6:.0f}M")
 
 
     pl.xlabel("Days")
@@ -69,19 +72,14 @@ def plot_performance_arb_only(all_prices):
 def plot_performance_both(all_prices):
     for liquidity_usd in [1e6, 1e7]:
 
-        all_lp_fees = []
-        all_lp_fees_arb = []
-
         fig, ax = pl.subplots()
         fig.set_size_inches((5, 3.5))
 
-        for sim in range(all_prices.shape[1]):
-            prices = all_prices[:,sim]
-            num_blocks = len(prices)
-            lvr, lp_fees, lp_fees_arb, volume, volume_arb = \
-                estimate_performance(prices, generate_trades(), liquidity_usd)
-            all_lp_fees.append(lp_fees)
-            all_lp_fees_arb.append(lp_fees_arb)
+        num_blocks = all_prices.shape[0]
+        trades = [trade_store.get(SWEEP_SEED, sim) for sim in range(all_prices.shape[1])]
+        lvr, all_lp_fees, all_lp_fees_arb, volume, volume_arb = np.array(
+            [estimate_performance_cached(all_prices[:,sim], trades[sim], liquidity_usd)
+             for sim in range(all_prices.shape[1])]).T
 
         duration_days = num_blocks * BLOCK_TIME_SEC / 86400
 
@@ -113,21 +111,23 @@ def plot_pnl_vs_liquidity(all_prices):
 
     pnls_per_day = []
 
-    for liquidity_usd in liq:
-        print(liquidity_usd)
-        all_lp_pnl = []
-
-        for sim in range(all_prices.shape[1]):
-            prices = all_prices[:,sim]
-            num_blocks = len(prices)
-            lvr, lp_fees, lp_fees_arb, volume, volume_arb = \
-                estimate_performance(prices, generate_trades(), liquidity_usd)
-
-            lp_pnl = lp_fees - lvr
-            all_lp_pnl.append(lp_pnl)
+    # simulate the (liquidity, path) grid points in parallel
+    num_blocks = all_prices.shape[0]
+    results = run_sweep(estimate_performance_batch_cached, all_prices, liq,
+                        batch=True, levels_per_task=SWEEP_LEVELS_PER_TASK,
+                        store=ResultStore(RESULTS_FILENAME), params=f"price_seed={PRICE_PATH_SEED}")
+    lvr, lp_fees = results[:,:,0], results[:,:,1]
+    grid_lp_pnl = lp_fees - lvr
 
+    variance = price_weighted_variance(all_prices)
+    for liquidity_usd, all_lp_pnl in zip(liq, grid_lp_pnl):
+        print(liquidity_usd)
         duration_days = num_blocks * BLOCK_TIME_SEC / 86400
-        avg_total_pnl = sum(all_lp_pnl) / NUM_SIMULATIONS
+        # the analytical PnL of each path is the control variate, which reduces the error of the mean
+        control, control_mean = analytical_pnl(all_prices, liquidity_usd, variance=variance)
+        avg_total_pnl, error, _ = control_variate_mean(all_lp_pnl, control, control_mean)
+        print(f"   PnL/day={avg_total_pnl / duration_days:.1f}±{error / duration_days:.1f}"
+              f" (without the control variate: ±{plain_mean(all_lp_pnl)[1] / duration_days:.1f})")
 
         pnl_per_day = avg_total_pnl / duration_days
         pnls_per_day.append(pnl_per_day)
@@ -149,7 +149,7 @@ def plot_pnl_vs_liquidity(all_prices):
  
 def main():
     mpl_style(False)
-    np.random.seed(123456)
+    np.random.seed(PRICE_PATH_SEED)
     n = SIMULATION_DURATION_BLOCKS
     all_prices = get_price_paths(n, sigma=ETH_VOLATILITY_PER_BLOCK, mu=0.0)
     plot_performance_arb_only(all_prices)
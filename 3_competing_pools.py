@@ -9,11 +9,26 @@ import numpy as np
 from ing_theme_matplotlib import mpl_style
 from dex import DEX, POOL_FEE_PIPS
 from common import *
-from simulation import get_price_paths, estimate_performance, estimate_performance_twopools, generate_trades, OTHER_DEX_LIQUDITY_USD
+from simulation import get_price_paths, estimate_performance, estimate_performance_twopools, OTHER_DEX_LIQUDITY_USD
+from sweep import run_sweep, SWEEP_SEED
+from trade_store import TradeStore
+from results_store import ResultStore
+from memo import Memoized
 
 # Constants for plotting
 pl.rcParams["savefig.dpi"] = 200
 
+# the same trade sets are replayed at every liquidity level
+trade_store = TradeStore()
+
+estimate_performance_cached = Memoized(estimate_performance)
+estimate_performance_twopools_cached = Memoized(estimate_performance_twopools)
+
+PRICE_PATH_SEED = 123456
+
+# the results of the liquidity sweep are kept here; delete the file to simulate again
+RESULTS_FILENAME = "3_results.bin"
+
 ############################################################
 
 def plot_performance_both(all_prices):
@@ -29,7 +44,7 @@ def plot_performance_both(all_prices):
             prices = all_prices[:,sim]
             num_blocks = len(prices)
             lvr, lp_fees, lp_fees_arb, volume, volume_arb, _ = \
-                estimate_performance_twopools(prices, generate_trades(), liquidity_usd)
+                estimate_performance_twopools_cached(prices, trade_store.get(SWEEP_SEED, sim), liquidity_usd)
             all_lp_fees.append(lp_fees)
             all_lp_fees_arb.append(lp_fees_arb)
 
@@ -54,6 +69,12 @@ def plot_performance_both(all_prices):
 
 ############################################################
 
+# simulates the same price path and trades in the competitive and in the single-pool market
+def estimate_performance_both_markets(prices, trades, liquidity_usd):
+    return estimate_performance_twopools_cached(prices, trades, liquidity_usd) + \
+        estimate_performance_cached(prices, trades, liquidity_usd)
+
+
 def plot_pnl_vs_liquidity(all_prices):
     fig, ax = pl.subplots()
     fig.set_size_inches((5, 3.5))
@@ -70,33 +91,18 @@ def plot_pnl_vs_liquidity(all_prices):
     apr_otherpool = []
     apr_singlepool = []
 
-    for liquidity_usd in liq:
-        print(liquidity_usd)
-        lp_pnl_singlepool = []
-        lp_pnl_twopool = []
-        volumes_my = []
-        volumes_other = []
-        volumes_my_singlepool = []
-
-        for sim in range(all_prices.shape[1]):
-            prices = all_prices[:,sim]
-            num_blocks = len(prices)
-            trades = generate_trades()
-            lvr, lp_fees, lp_fees_arb, volume, volume_arb, volume_other = \
-                estimate_performance_twopools(prices, trades, liquidity_usd)
+    # the (liquidity x simulation) grid runs in parallel
+    num_blocks = all_prices.shape[0]
+    results = run_sweep(estimate_performance_both_markets, all_prices, liq,
+                        store=ResultStore(RESULTS_FILENAME), params=f"price_seed={PRICE_PATH_SEED}")
 
-            volumes_my.append(volume)
-            volumes_other.append(volume_other)
-
-            lp_pnl = lp_fees - lvr
-            lp_pnl_twopool.append(lp_pnl)
-
-            lvr, lp_fees, lp_fees_arb, volume, volume_arb = \
-                estimate_performance(prices, trades, liquidity_usd)
+    for liquidity_usd, level_results in zip(liq, results):
+        print(liquidity_usd)
+        lvr, lp_fees, lp_fees_arb, volumes_my, volume_arb, volumes_other = level_results[:,:6].T
+        lp_pnl_twopool = lp_fees - lvr
 
-            lp_pnl = lp_fees - lvr
-            lp_pnl_singlepool.append(lp_pnl)
-            volumes_my_singlepool.append(volume)
+        lvr, lp_fees, lp_fees_arb, volumes_my_singlepool, volume_arb = level_results[:,6:].T
+        lp_pnl_singlepool = lp_fees - lvr
 
         duration_days = num_blocks * BLOCK_TIME_SEC / 86400
         avg_volume_my = np.mean(volumes_my)
@@ -168,7 +174,7 @@ def plot_pnl_vs_liquidity(all_prices):
     
 def main():
     mpl_style(False)
-    np.random.seed(123456)
+    np.random.seed(PRICE_PATH_SEED)
     n = SIMULATION_DURATION_BLOCKS
     all_prices = get_price_paths(n, sigma=ETH_VOLATILITY_PER_BLOCK, mu=0.0)
     plot_performance_both(all_prices)
@@ -0,0 +1,102 @@
+#
+# This file runs a varying number of simulations per liquidity level:
+# each level gets new simulations until the confidence interval of its
+# mean LP PnL is narrow enough, or until the simulation budget runs out.
+#
+
+import numpy as np
+from common import *
+from simulation import estimate_performance, PriceStream
+from trade_store import TradeStore
+
+############################################################
+
+ADAPTIVE_SEED = 123456
+
+# the 95% confidence interval
+CONFIDENCE_Z = 1.96
+
+# stop once the mean LP PnL per day is known to within this many $ (half width of the interval)
+TARGET_PNL_CI_USD_PER_DAY = 50.0
+
+MIN_SIMULATIONS = 10
+MAX_SIMULATIONS = 400
+
+# the tracked metrics, all per day
+PNL = 0
+LP_FEES = 1
+VOLUME = 2
+NUM_METRICS = 3
+
+############################################################
+
+# Welford's streaming mean and variance, for several metrics at once
+class RunningStats:
+    def __init__(self, num_metrics=NUM_METRICS):
+        self.count = 0
+        self.mean = np.zeros(num_metrics)
+        self.m2 = np.zeros(num_metrics)
+
+
+    def add(self, values):
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+
+
+    def variance(self):
+        if self.count < 2:
+            return np.full(len(self.mean), np.inf)
+        return self.m2 / (self.count - 1)
+
+
+    def half_width(self, z=CONFIDENCE_Z):
+        return z * np.sqrt(self.variance() / max(self.count, 1))
+
+############################################################
+
+# Runs `simulate(prices, trades, liquidity_usd)` (`estimate_performance` or
+# `estimate_performance_twopools`) at each liquidity level until the confidence
+# interval half width of the LP PnL per day is at most `target_pnl_ci`.
+# The simulation `sim` uses the same price path and trades at every level:
+# the column `sim` of `all_prices` if given (which also limits the budget),
+# otherwise a seeded `PriceStream` of `n` blocks.
+# Returns the arrays `(mean, half_width, count)`; the first two have shape
+# (len(liquidities), NUM_METRICS) and hold the PnL, LP fees and volume per day.
+def run_adaptive(liquidities, simulate=estimate_performance, all_prices=None,
+                 n=SIMULATION_DURATION_BLOCKS, sigma=ETH_VOLATILITY_PER_BLOCK, mu=0.0,
+                 target_pnl_ci=TARGET_PNL_CI_USD_PER_DAY,
+                 min_sims=MIN_SIMULATIONS, max_sims=MAX_SIMULATIONS, seed=ADAPTIVE_SEED):
+    if all_prices is not None:
+        n = all_prices.shape[0]
+        max_sims = min(max_sims, all_prices.shape[1])
+    duration_days = n * BLOCK_TIME_SEC / 86400
+    trade_store = TradeStore()
+
+    means = np.zeros((len(liquidities), NUM_METRICS))
+    half_widths = np.zeros((len(liquidities), NUM_METRICS))
+    counts = np.zeros(len(liquidities), dtype=np.int64)
+
+    for level, liquidity_usd in enumerate(liquidities):
+        stats = RunningStats()
+        for sim in range(max_sims):
+            if all_prices is not None:
+                prices = all_prices[:,sim]
+            else:
+                # the trades of the simulation come from the seed sequence [seed, sim] itself
+                # (see `TradeStore`), so the path uses a child of it, which is independent of them
+                prices = PriceStream(n, sigma, mu, seed=np.random.SeedSequence([seed, sim]).spawn(1)[0])
+            trades = trade_store.get(seed, sim, duration_days=duration_days)
+            metrics = simulate(prices, trades, liquidity_usd)
+            lvr, lp_fees, volume = metrics[0], metrics[1], metrics[3]
+            stats.add(np.array([lp_fees - lvr, lp_fees, volume]) / duration_days)
+            if stats.count >= min_sims and stats.half_width()[PNL] <= target_pnl_ci:
+                break
+
+        print(f"liquidity_usd={liquidity_usd:.0f} simulations={stats.count} PnL/day={stats.mean[PNL]:.1f}±{stats.half_width()[PNL]:.1f}")
+        means[level] = stats.mean
+        half_widths[level] = stats.half_width()
+        counts[level] = stats.count
+
+    return means, half_widths, counts
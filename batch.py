@@ -0,0 +1,350 @@
+#
+# This file simulates many constant product AMM DEX pools at once.
+# The state of the pools is held in NumPy arrays (one entry per pool),
+# and all pools are stepped through each block together.
+# The arithmetic mirrors `dex.DEX` operation by operation,
+# so the results match the scalar simulation.
+#
+
+import numpy as np
+from common import *
+from dex import POOL_LIQUIDITY_USD, POOL_FEE_PIPS, DEFAULT_BASEFEE_USD
+from simulation import build_trade_schedule, MIN_SEARCH_WINDOW_BLOCKS, MAX_SEARCH_WINDOW_BLOCKS
+
+############################################################
+
+class BatchDEX:
+    def __init__(self, num_pools, pool_liquidity_usd=POOL_LIQUIDITY_USD):
+        self.num_pools = num_pools
+
+        # -- parameters (per pool)
+        self.fee_pips = np.full(num_pools, float(POOL_FEE_PIPS))
+        self.fee_factor = 1_000_000 / (1_000_000 - self.fee_pips)
+        self.basefee_usd = np.full(num_pools, float(DEFAULT_BASEFEE_USD))
+        self.block_time_sec = BLOCK_TIME_SEC
+        # -- pools' state
+        self.reserve_x = np.zeros(num_pools)
+        self.reserve_y = np.zeros(num_pools)
+        self.set_liquidity_usd(pool_liquidity_usd)
+        # -- cumulative metrics
+        self.volume = np.zeros(num_pools)
+        self.volume_arb = np.zeros(num_pools)
+        self.lp_fees = np.zeros(num_pools)
+        self.lp_fees_arb = np.zeros(num_pools)
+        self.lvr = np.zeros(num_pools)
+        self.sbp_profits = np.zeros(num_pools)
+        self.basefees = np.zeros(num_pools)
+        self.num_tx = np.zeros(num_pools, dtype=np.int64)
+
+
+    def set_fee_bps(self, fee_bps):
+        self.fee_pips = np.broadcast_to(np.asarray(fee_bps, dtype=float) * 100, (self.num_pools,)).copy()
+        self.fee_factor = 1_000_000 / (1_000_000 - self.fee_pips)
+
+
+    def set_basefee_usd(self, basefee_usd):
+        self.basefee_usd = np.broadcast_to(np.asarray(basefee_usd, dtype=float), (self.num_pools,)).copy()
+
+
+    def set_liquidity_usd(self, liquidity_usd):
+        liquidity_usd = np.broadcast_to(np.asarray(liquidity_usd, dtype=float), (self.num_pools,))
+        self.reserve_y = liquidity_usd / 2
+        self.reserve_x = self.reserve_y / ETH_PRICE
+
+
+    def price(self):
+        return self.reserve_y / self.reserve_x
+
+
+    def liquidity(self):
+        return np.sqrt(self.reserve_x * self.reserve_y)
+
+
+    def liquidity_usd(self):
+        return liquidity_to_value(self.liquidity())
+
+
+    # the arrays `(price_low, price_high)`; see `DEX.get_no_trade_region`
+    def get_no_trade_region(self):
+        p = self.price()
+        sqrt_p = np.sqrt(p)
+        L = self.liquidity()
+        basefee = self.basefee_usd * 0.999
+        sqrt_high = sqrt_p + np.sqrt(basefee * sqrt_p / (L * self.fee_factor))
+        sqrt_low = np.maximum(sqrt_p - np.sqrt(basefee * sqrt_p / L), 0.0)
+        price_high = self.fee_factor * sqrt_high * sqrt_high * (1 - 1e-12)
+        price_low = sqrt_low * sqrt_low / self.fee_factor * (1 + 1e-12)
+        return price_low, price_high
+
+
+    # `idx` selects the pools that execute the swap, one swap per pool
+    def swap_x_to_y(self, idx, amount_in_x):
+        reserve_x = self.reserve_x[idx]
+        reserve_y = self.reserve_y[idx]
+        basefee_usd = self.basefee_usd[idx]
+        price = reserve_y / reserve_x
+
+        # remove the gas fee first
+        amount_in_x = amount_in_x - basefee_usd / price
+        y_out = np.zeros(len(amount_in_x))
+        ok = amount_in_x > 0
+        if not ok.all():
+            idx, amount_in_x, price = idx[ok], amount_in_x[ok], price[ok]
+            reserve_x, reserve_y, basefee_usd = reserve_x[ok], reserve_y[ok], basefee_usd[ok]
+
+        amount_in_x_without_fee = amount_in_x / self.fee_factor[idx]
+        self.lp_fees[idx] += (amount_in_x - amount_in_x_without_fee) * price
+        reserve_x = reserve_x + amount_in_x_without_fee
+        out = amount_in_x_without_fee * reserve_y / reserve_x
+        self.reserve_x[idx] = reserve_x
+        self.reserve_y[idx] = reserve_y - out
+
+        self.volume[idx] += amount_in_x * price
+        self.num_tx[idx] += 1
+        self.basefees[idx] += basefee_usd
+        y_out[ok] = out
+        return y_out
+
+
+    def swap_y_to_x(self, idx, amount_in_y):
+        reserve_x = self.reserve_x[idx]
+        reserve_y = self.reserve_y[idx]
+        basefee_usd = self.basefee_usd[idx]
+
+        # remove the gas fee first
+        amount_in_y = amount_in_y - basefee_usd
+        x_out = np.zeros(len(amount_in_y))
+        ok = amount_in_y > 0
+        if not ok.all():
+            idx, amount_in_y = idx[ok], amount_in_y[ok]
+            reserve_x, reserve_y, basefee_usd = reserve_x[ok], reserve_y[ok], basefee_usd[ok]
+
+        amount_in_y_without_fee = amount_in_y / self.fee_factor[idx]
+        self.lp_fees[idx] += amount_in_y - amount_in_y_without_fee
+        reserve_y = reserve_y + amount_in_y_without_fee
+        out = amount_in_y_without_fee * reserve_x / reserve_y
+        self.reserve_y[idx] = reserve_y
+        self.reserve_x[idx] = reserve_x - out
+
+        self.volume[idx] += amount_in_y
+        self.num_tx[idx] += 1
+        self.basefees[idx] += basefee_usd
+        x_out[ok] = out
+        return x_out
+
+
+    # returns a boolean array: True for the pools where the arbitrage trade happened
+    def maybe_arbitrage(self, cex_price, account_lvr=True):
+        dex_price = self.reserve_y / self.reserve_x
+        up = cex_price > dex_price
+        target_price = np.where(up, cex_price / self.fee_factor, cex_price * self.fee_factor)
+        # the trade does not happen when the CEX/DEX price difference is below the LP fee
+        possible = np.where(up, target_price >= dex_price, target_price <= dex_price)
+        if not possible.any():
+            return possible
+
+        sqrt_target_price = np.sqrt(target_price)
+        L = np.sqrt(self.reserve_x * self.reserve_y)
+        delta_x = L / sqrt_target_price - self.reserve_x
+        delta_y = L * sqrt_target_price - self.reserve_y
+        # compute the LP fees using CEX prices
+        lp_fee = np.where(delta_x > 0,
+                          (delta_x * self.fee_factor - delta_x) * cex_price,
+                          delta_y * self.fee_factor - delta_y)
+
+        single_transaction_lvr = -(delta_x * cex_price + delta_y)
+        sbp_profit = single_transaction_lvr - lp_fee - self.basefee_usd
+        # the trade does not happen due to the friction from the blockchain base fee
+        trade = possible & (sbp_profit > 0.0)
+        if not trade.any():
+            return trade
+
+        # trade happens; first update the pools' state
+        # (adding zero leaves the other pools bit-for-bit unchanged)
+        self.reserve_x = self.reserve_x + np.where(trade, delta_x, 0.0)
+        self.reserve_y = self.reserve_y + np.where(trade, delta_y, 0.0)
+
+        # then update the cumulative metrics
+        volume = np.where(trade, np.abs(delta_y) + lp_fee, 0.0)
+        lp_fee = np.where(trade, lp_fee, 0.0)
+        self.volume += volume
+        self.lp_fees += lp_fee
+        self.basefees += np.where(trade, self.basefee_usd, 0.0)
+        self.num_tx += trade
+        # if this was backrun or sandwich, ignore any hypothetical LVR
+        if account_lvr:
+            self.volume_arb += volume
+            self.lp_fees_arb += lp_fee
+            self.lvr += np.where(trade, single_transaction_lvr, 0.0)
+            self.sbp_profits += np.where(trade, sbp_profit, 0.0)
+
+        return trade
+
+############################################################
+
+# Turns per-pool noise trades into a flat list of swaps ordered by block,
+# using the same schedule as `simulation.estimate_performance`.
+# Within a block, the swaps are grouped in rounds: the r-th round holds the r-th swap
+# of each pool that has at least r swaps in that block.
+def _build_noise_schedule(n, noise_trades, max_swap):
+    all_blocks = []
+    all_pools = []
+    all_amounts = []
+    for pool, trades in enumerate(noise_trades):
+        offsets, amounts = build_trade_schedule(trades, n, max_swap[pool])
+        all_blocks.append(np.repeat(np.arange(n), np.diff(offsets)))
+        all_pools.append(np.full(len(amounts), pool))
+        all_amounts.append(amounts)
+
+    blocks = np.concatenate(all_blocks)
+    pools = np.concatenate(all_pools)
+    amounts = np.concatenate(all_amounts)
+
+    # the rank of each swap within its (block, pool) group; the input is sorted by block per pool
+    order = np.lexsort((pools, blocks))
+    blocks, pools, amounts = blocks[order], pools[order], amounts[order]
+    group_start = np.ones(len(blocks), dtype=bool)
+    group_start[1:] = (blocks[1:] != blocks[:-1]) | (pools[1:] != pools[:-1])
+    positions = np.arange(len(blocks))
+    rank = positions - np.maximum.accumulate(np.where(group_start, positions, 0))
+
+    # stable sort keeps the original trade order of each pool
+    order = np.lexsort((rank, blocks))
+    blocks, rank, pools, amounts = blocks[order], rank[order], pools[order], amounts[order]
+    round_start = np.ones(len(blocks), dtype=bool)
+    round_start[1:] = (blocks[1:] != blocks[:-1]) | (rank[1:] != rank[:-1])
+    round_bounds = np.append(np.flatnonzero(round_start), len(blocks))
+    round_blocks = blocks[round_bounds[:-1]]
+    block_rounds = np.searchsorted(round_blocks, np.arange(n + 1))
+    return block_rounds, round_bounds, pools, amounts
+
+############################################################
+
+def _block_prices(all_prices, i, paths):
+    if paths is None:
+        return all_prices[i]
+    return all_prices[i][paths]
+
+
+MIN_SKIPPED_BLOCKS = 4
+MAX_DENSE_BLOCKS = 64
+
+# The batched counterpart of `simulation.find_next_outside`: the first block from `start`
+# where the price of any pool is outside of its no-trade region `(price_low, price_high)`,
+# or `n` if there is none. The window starts small, as the trades often come in bursts.
+def _find_next_outside(all_prices, paths, start, price_low, price_high):
+    n = len(all_prices)
+    window = 8
+    while start < n:
+        end = min(start + window, n)
+        chunk = all_prices[start:end] if paths is None else all_prices[start:end][:,paths]
+        outside = np.flatnonzero(((chunk < price_low) | (chunk > price_high)).any(axis=1))
+        if len(outside):
+            return start + outside[0]
+        start = end
+        window = min(max(2 * window, MIN_SEARCH_WINDOW_BLOCKS), MAX_SEARCH_WINDOW_BLOCKS)
+    return n
+
+############################################################
+
+# Batched version of `simulation.estimate_performance`.
+# `all_prices` has shape (n, M): one price path per pool. A single path of shape (n,)
+# is shared by all pools, e.g. when the pools differ only by liquidity.
+# `paths` optionally maps each pool to a column of `all_prices`, so that a whole
+# (liquidity x simulation) grid can run in one batch without copying the price paths.
+# `noise_trades` is either None (arbitrage only) or a list with one trade set per pool.
+# `liquidity_usd`, `fee_bps` and `basefee_usd` are each either a scalar or an array with one entry per pool
+# (the defaults of `DEX` if None).
+# With a `recorder` (see `recorder.py`) that has one run per pool, the state of the pools
+# is recorded every `recorder.every` blocks.
+# Returns the tuple `(lvr, lp_fees, lp_fees_arb, volume, volume_arb)` of arrays, one entry per pool.
+def estimate_performance_batch(all_prices, noise_trades=None, liquidity_usd=None, paths=None, recorder=None,
+                               fee_bps=None, basefee_usd=None):
+    all_prices = np.asarray(all_prices, dtype=float)
+    if all_prices.ndim == 1:
+        all_prices = all_prices[:,None]
+    n = len(all_prices)
+    if paths is not None:
+        num_pools = len(paths)
+    elif all_prices.shape[1] > 1:
+        num_pools = all_prices.shape[1]
+    elif liquidity_usd is not None and np.ndim(liquidity_usd) > 0:
+        num_pools = len(liquidity_usd)
+    elif noise_trades is not None:
+        num_pools = len(noise_trades)
+    else:
+        num_pools = 1
+    if paths is None and all_prices.shape[1] == 1:
+        paths = np.zeros(num_pools, dtype=np.int64)
+
+    dex = BatchDEX(num_pools)
+    if liquidity_usd is not None:
+        dex.set_liquidity_usd(liquidity_usd)
+    if fee_bps is not None:
+        dex.set_fee_bps(fee_bps)
+    if basefee_usd is not None:
+        dex.set_basefee_usd(basefee_usd)
+
+    if noise_trades is None:
+        trade_blocks = []
+    else:
+        assert len(noise_trades) == num_pools
+        max_swap = swap_size_from_liquidity(dex.liquidity_usd(), MAX_PRICE_IMPACT_PCT / 100)
+        block_rounds, round_bounds, pools, amounts = _build_noise_schedule(n, noise_trades, max_swap)
+        trade_blocks = np.flatnonzero(np.diff(block_rounds)).tolist()
+
+    # The blocks without noise trades where the price of every pool is inside its no-trade region
+    # are skipped, since nothing can happen in them. The state of the pools is the same
+    # in the skipped blocks, so their recording points are recorded before the next visited block.
+    # When few blocks can be skipped (e.g. some pool is arbitraged in almost every block),
+    # the search is not worth its cost: after each search that skips fewer than `MIN_SKIPPED_BLOCKS`,
+    # the next `dense_blocks` blocks are visited without one (doubling up to `MAX_DENSE_BLOCKS`).
+    record_blocks = recorder.blocks.tolist() if recorder is not None else []
+    next_record = 0
+    next_trade = 0
+    dense_blocks = 0
+    dense_until = 0
+    i = 0
+    while i < n:
+        if i < dense_until:
+            j = i
+        else:
+            price_low, price_high = dex.get_no_trade_region()
+            j = _find_next_outside(all_prices, paths, i, price_low, price_high)
+            while next_trade < len(trade_blocks) and trade_blocks[next_trade] < i:
+                next_trade += 1
+            if next_trade < len(trade_blocks):
+                j = min(j, trade_blocks[next_trade])
+            if j - i < MIN_SKIPPED_BLOCKS:
+                dense_blocks = min(max(2 * dense_blocks, 1), MAX_DENSE_BLOCKS)
+                dense_until = j + 1 + dense_blocks
+            else:
+                dense_blocks //= 2
+        while next_record < len(record_blocks) and record_blocks[next_record] < j:
+            recorder.record(next_record, dex)
+            next_record += 1
+        if j >= n:
+            break
+
+        # first execute the arbitrage (may include a backrun)
+        cex_price = _block_prices(all_prices, j, paths)
+        dex.maybe_arbitrage(cex_price)
+        if noise_trades is not None:
+            # then execute the noise trades
+            for r in range(block_rounds[j], block_rounds[j + 1]):
+                idx = pools[round_bounds[r]:round_bounds[r + 1]]
+                trade_amount = amounts[round_bounds[r]:round_bounds[r + 1]]
+                sell = trade_amount < 0
+                if sell.any():
+                    dex.swap_x_to_y(idx[sell], -trade_amount[sell] / cex_price[idx[sell]])
+                if not sell.all():
+                    buy = ~sell
+                    dex.swap_y_to_x(idx[buy], trade_amount[buy])
+            # check if backrun can be done in the same block
+            dex.maybe_arbitrage(cex_price, account_lvr=False)
+        if next_record < len(record_blocks) and record_blocks[next_record] == j:
+            recorder.record(next_record, dex)
+            next_record += 1
+        i = j + 1
+
+    return dex.lvr, dex.lp_fees, dex.lp_fees_arb, dex.volume, dex.volume_arb
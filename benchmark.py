@@ -0,0 +1,192 @@
+#
+# This file benchmarks the simulation core: the price paths, the noise trades,
+# the single pool simulation (arbitrage only and with noise trades), the two pool
+# simulation and the routing functions, with fixed seeds and several sizes.
+# The times, the peak memory and the metrics are written to a JSON file and
+# compared with a baseline: the times may not grow by more than the threshold,
+# and the metrics must be exactly the same.
+#
+# Usage:
+#   python benchmark.py --save-baseline   # on the reference version
+#   python benchmark.py                   # after a change
+#
+
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+from time import perf_counter
+import numpy as np
+from dex import DEX
+from common import *
+from simulation import get_price_paths, estimate_performance, estimate_performance_twopools, \
+    generate_trades, route_swap_x_to_y, route_swap_y_to_x
+from memo import fingerprint
+
+############################################################
+
+BENCHMARK_SEED = 123456
+
+BASELINE_FILENAME = "benchmark_baseline.json"
+RESULTS_FILENAME = "benchmark_results.json"
+
+# a case is slower if its time grew by more than this fraction
+REGRESSION_THRESHOLD = 0.2
+
+# the slow cases are not repeated beyond this total time
+MAX_REPEAT_TIME_SEC = 10.0
+
+# the memory is measured in an extra run with `tracemalloc`, which slows down
+# the Python loops several times, so it is skipped for the slow cases
+MAX_MEMORY_RUN_SEC = 5.0
+
+BLOCKS_PER_DAY = 86400 // BLOCK_TIME_SEC
+
+# the sizes: (name, number of days, number of paths, liquidity levels)
+SIZES = [("1d", 1, 1, [1e6, 1e8]), ("10d", 10, 1, [1e6, 1e8]), ("1d_100paths", 1, 100, [1e6])]
+
+############################################################
+
+# Converts the result of a case to a list of values that can be stored in JSON
+# and compared exactly: numbers as floats, arrays as their hash.
+def to_metrics(result):
+    if isinstance(result, np.ndarray):
+        return [fingerprint(result)]
+    return [float(u) if np.ndim(u) == 0 else fingerprint(np.asarray(u)) for u in result]
+
+
+def make_prices(days, num_paths):
+    np.random.seed(BENCHMARK_SEED)
+    return get_price_paths(days * BLOCKS_PER_DAY, ETH_VOLATILITY_PER_BLOCK, 0.0, num_paths)
+
+
+def make_trades(days, num_paths):
+    return [generate_trades(np.random.default_rng([BENCHMARK_SEED, sim]), duration_days=days)
+            for sim in range(num_paths)]
+
+
+def run_paths(all_prices, all_trades, simulate, liquidity_usd):
+    metrics = []
+    for sim in range(all_prices.shape[1]):
+        trades = all_trades[sim] if all_trades is not None else None
+        metrics.append(simulate(all_prices[:,sim], trades, liquidity_usd))
+    return np.sum(metrics, axis=0)
+
+
+def run_routing(all_trades, price):
+    dex_my = DEX()
+    dex_other = DEX()
+    dex_my.set_liquidity_usd(1e6)
+    dex_other.set_liquidity_usd(OTHER_DEX_LIQUDITY_USD)
+    for trades in all_trades:
+        for trade_amount in trades:
+            if trade_amount < 0:
+                route_swap_x_to_y(-trade_amount / price, dex_my, dex_other)
+            else:
+                route_swap_y_to_x(trade_amount, dex_my, dex_other)
+    return (dex_my.reserve_x, dex_my.reserve_y, dex_my.lp_fees, dex_my.volume,
+            dex_other.reserve_x, dex_other.reserve_y, dex_other.lp_fees, dex_other.volume)
+
+
+# Returns the list of cases `(name, setup, run)`; `run(*setup())` is timed.
+def get_cases():
+    cases = []
+    for size, days, num_paths, liquidities in SIZES:
+        cases.append((f"get_price_paths_{size}", lambda: (),
+                      lambda days=days, num_paths=num_paths: make_prices(days, num_paths)))
+        cases.append((f"generate_trades_{size}", lambda: (),
+                      lambda days=days, num_paths=num_paths: make_trades(days, num_paths)))
+
+        setup_arb = lambda days=days, num_paths=num_paths: (make_prices(days, num_paths), None)
+        setup_noise = lambda days=days, num_paths=num_paths: (make_prices(days, num_paths), make_trades(days, num_paths))
+        for liquidity_usd in liquidities:
+            liq = f"{liquidity_usd:.0e}".replace("+0", "")
+            cases.append((f"arb_only_{size}_L{liq}", setup_arb,
+                          lambda p, t, liquidity_usd=liquidity_usd: run_paths(p, t, estimate_performance, liquidity_usd)))
+            cases.append((f"noise_{size}_L{liq}", setup_noise,
+                          lambda p, t, liquidity_usd=liquidity_usd: run_paths(p, t, estimate_performance, liquidity_usd)))
+        cases.append((f"twopools_{size}", setup_noise,
+                      lambda p, t: run_paths(p, t, estimate_performance_twopools, 1e6)))
+        cases.append((f"routing_{size}", lambda days=days, num_paths=num_paths: (make_trades(days, num_paths),),
+                      lambda t: run_routing(t, ETH_PRICE)))
+    return cases
+
+
+def run_case(setup, run, repeats, measure_memory):
+    args = setup()
+    times = []
+    while len(times) < repeats and sum(times) < MAX_REPEAT_TIME_SEC:
+        start = perf_counter()
+        result = run(*args)
+        times.append(perf_counter() - start)
+    peak_memory = None
+    if measure_memory and min(times) <= MAX_MEMORY_RUN_SEC:
+        tracemalloc.start()
+        run(*args)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {"time_sec": min(times), "times_sec": times, "peak_memory_bytes": peak_memory,
+            "metrics": to_metrics(result)}
+
+############################################################
+
+# Returns the list of problems found: slower cases and changed metrics
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    problems = []
+    for name, result in results["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        base = baseline["cases"][name]
+        ratio = result["time_sec"] / base["time_sec"]
+        status = ""
+        if ratio > 1 + threshold:
+            status = "SLOWER"
+            problems.append(f"{name}: {ratio:.2f}x slower ({base['time_sec']:.3f}s -> {result['time_sec']:.3f}s)")
+        if result["metrics"] != base["metrics"]:
+            status += " METRICS CHANGED"
+            problems.append(f"{name}: metrics changed: {base['metrics']} -> {result['metrics']}")
+        print(f"{name:32} {base['time_sec']:8.3f}s -> {result['time_sec']:8.3f}s  {ratio:5.2f}x {status}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the simulation core")
+    parser.add_argument("--only", default="", help="run only the cases whose name contains this")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="do not measure the peak memory")
+    parser.add_argument("--output", default=RESULTS_FILENAME)
+    parser.add_argument("--baseline", default=BASELINE_FILENAME)
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    results = {"python": sys.version.split()[0], "numpy": np.__version__,
+               "machine": platform.machine(), "cases": {}}
+    for name, setup, run in get_cases():
+        if args.only not in name:
+            continue
+        results["cases"][name] = run_case(setup, run, args.repeats, not args.no_memory)
+        case = results["cases"][name]
+        memory = f"{case['peak_memory_bytes'] / 1e6:8.1f} MB" if case["peak_memory_bytes"] is not None else ""
+        print(f"{name:32} {case['time_sec']:8.3f}s {memory}")
+
+    with open(args.baseline if args.save_baseline else args.output, "w") as f:
+        json.dump(results, f, indent=1)
+    if args.save_baseline:
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"no baseline in {args.baseline}; run with --save-baseline first")
+        return 0
+    problems = compare(results, baseline, args.threshold)
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
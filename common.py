@@ -46,6 +46,9 @@ SIMULATION_DURATION_DAYS = SIMULATION_DURATION_SEC // 86400
 
 NUM_SIMULATIONS = 40 # this is very small, but enough for recognizable patterns in the results
 
+# the number of worker processes for the liquidity sweeps (None: one per CPU core)
+NUM_WORKERS = None
+
 MAX_PRICE_IMPACT_PCT = 0.01
 
 # this is the expected upper bound of the noise volume
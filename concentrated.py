@@ -0,0 +1,505 @@
+#
+# This file simulates a concentrated liquidity (Uniswap v3 style) AMM DEX.
+# The liquidity is provided in positions over price ranges [1.0001^tick_lower, 1.0001^tick_upper),
+# and only the positions that contain the current price are active.
+# A swap moves the price along the constant product curve of the active liquidity
+# and crosses the initialized ticks on its way, where the active liquidity changes.
+#
+# The initialized ticks are indexed by a bitmap of 256-bit words, as in Uniswap v3,
+# plus the sorted list of its non-empty words: the next initialized tick is found
+# with bit operations within a word, and with a binary search across the words,
+# so swaps and arbitrage cost O(log n) per crossed tick, however many positions there are.
+#
+# `ConcentratedDEX` has the same swap and arbitrage interface and the same metrics as `dex.DEX`,
+# so it can be passed to `simulation.estimate_performance(..., dex=...)` and
+# `simulation.estimate_performance_twopools`. The amounts are floats, not fixed point integers.
+# The "reserves" are the virtual reserves of the active liquidity, so with a single
+# full range position the pool behaves as `DEX` (up to rounding).
+#
+
+from bisect import bisect_left, bisect_right, insort
+from math import floor, log, sqrt
+from common import *
+from dex import POOL_LIQUIDITY_USD, POOL_FEE_PIPS, DEFAULT_BASEFEE_USD
+
+############################################################
+
+TICK_BASE = 1.0001
+LOG_TICK_BASE = log(TICK_BASE)
+
+MIN_TICK = -887272
+MAX_TICK = 887272
+
+# corresponds to the 0.05% fee tier
+DEFAULT_TICK_SPACING = 10
+
+
+def sqrt_price_at_tick(tick):
+    return TICK_BASE ** (tick / 2)
+
+
+# the largest tick whose sqrt price is not above `sqrt_price`
+def tick_at_sqrt_price(sqrt_price):
+    tick = floor(2 * log(sqrt_price) / LOG_TICK_BASE)
+    # correct the rounding errors of the logarithm
+    while sqrt_price_at_tick(tick + 1) <= sqrt_price:
+        tick += 1
+    while sqrt_price_at_tick(tick) > sqrt_price:
+        tick -= 1
+    return tick
+
+############################################################
+
+class TickBitmap:
+    def __init__(self, tick_spacing=DEFAULT_TICK_SPACING):
+        self.tick_spacing = tick_spacing
+        # word index -> 256-bit word; bit `b` of word `w` is the tick `(256 * w + b) * tick_spacing`
+        self.words = {}
+        # the indices of the non-zero words, sorted
+        self.word_list = []
+
+
+    def flip(self, tick):
+        assert tick % self.tick_spacing == 0, "the tick must be a multiple of the tick spacing"
+        word, bit = divmod(tick // self.tick_spacing, 256)
+        old = self.words.get(word, 0)
+        new = old ^ (1 << bit)
+        if new:
+            self.words[word] = new
+            if not old:
+                insort(self.word_list, word)
+        else:
+            del self.words[word]
+            self.word_list.pop(bisect_left(self.word_list, word))
+
+
+    def is_initialized(self, tick):
+        word, bit = divmod(tick // self.tick_spacing, 256)
+        return bool(self.words.get(word, 0) >> bit & 1)
+
+
+    # Returns the nearest initialized tick at or below `tick` if `lte`, or above `tick` otherwise;
+    # None if there is no such tick
+    def next_initialized_tick(self, tick, lte):
+        spacing = self.tick_spacing
+        if lte:
+            word, bit = divmod(tick // spacing, 256)
+            masked = self.words.get(word, 0) & ((2 << bit) - 1)
+            if not masked:
+                k = bisect_left(self.word_list, word) - 1
+                if k < 0:
+                    return None
+                word = self.word_list[k]
+                masked = self.words[word]
+            # the most significant bit
+            return (256 * word + masked.bit_length() - 1) * spacing
+
+        word, bit = divmod(tick // spacing + 1, 256)
+        masked = self.words.get(word, 0) >> bit << bit
+        if not masked:
+            k = bisect_right(self.word_list, word)
+            if k == len(self.word_list):
+                return None
+            word = self.word_list[k]
+            masked = self.words[word]
+        # the least significant bit
+        return (256 * word + (masked & -masked).bit_length() - 1) * spacing
+
+############################################################
+
+class ConcentratedDEX:
+    __slots__ = ("fee_pips", "fee_factor", "basefee_usd", "block_time_sec", "tick_spacing",
+                 "sqrt_price", "tick", "active_liquidity", "liquidity_net", "liquidity_gross", "bitmap",
+                 "volume", "volume_arb", "lp_fees", "lp_fees_arb", "lvr", "sbp_profits", "basefees", "num_tx")
+
+    # starts at `ETH_PRICE` with a single full range position worth `pool_liquidity_usd`
+    def __init__(self, pool_liquidity_usd=POOL_LIQUIDITY_USD, tick_spacing=DEFAULT_TICK_SPACING):
+        # -- parameters
+        self.fee_pips = POOL_FEE_PIPS
+        self.fee_factor = 1_000_000 / (1_000_000 - self.fee_pips)
+        self.basefee_usd = DEFAULT_BASEFEE_USD
+        self.block_time_sec = BLOCK_TIME_SEC
+        self.tick_spacing = tick_spacing
+        # -- pool's state
+        self.sqrt_price = sqrt(ETH_PRICE)
+        self.tick = tick_at_sqrt_price(self.sqrt_price)
+        # the liquidity of the positions that contain the current price
+        self.active_liquidity = 0.0
+        # tick -> the change of the active liquidity when the price crosses the tick upwards
+        self.liquidity_net = {}
+        # tick -> the total liquidity of the positions that start or end at the tick
+        self.liquidity_gross = {}
+        self.bitmap = TickBitmap(tick_spacing)
+        self.set_liquidity_usd(pool_liquidity_usd)
+        # -- cumulative metrics
+        self.volume = 0
+        self.volume_arb = 0
+        self.lp_fees = 0
+        self.lp_fees_arb = 0
+        self.lvr = 0
+        self.sbp_profits = 0
+        self.basefees = 0
+        self.num_tx = 0
+
+
+    def minutes_to_blocks(self, time_minutes):
+        seconds = 60 * time_minutes
+        return seconds // self.block_time_sec
+
+
+    def set_fee_bps(self, fee_bps):
+        self.fee_pips = fee_bps * 100
+        self.fee_factor = 1_000_000 / (1_000_000 - self.fee_pips)
+
+
+    def set_basefee_usd(self, basefee_usd):
+        self.basefee_usd = basefee_usd
+
+    ############################################################
+    # positions
+
+    def full_range_ticks(self):
+        spacing = self.tick_spacing
+        return -(MAX_TICK // spacing) * spacing, (MAX_TICK // spacing) * spacing
+
+
+    def _update_tick(self, tick, liquidity_delta, upper):
+        gross = self.liquidity_gross.get(tick, 0.0)
+        new_gross = gross + liquidity_delta
+        # the rounding errors of the removed positions
+        if liquidity_delta < 0 and new_gross <= 1e-9 * gross:
+            new_gross = 0.0
+        if new_gross:
+            self.liquidity_gross[tick] = new_gross
+            self.liquidity_net[tick] = self.liquidity_net.get(tick, 0.0) + (-liquidity_delta if upper else liquidity_delta)
+        else:
+            self.liquidity_gross.pop(tick, None)
+            self.liquidity_net.pop(tick, None)
+        if bool(gross) != bool(new_gross):
+            self.bitmap.flip(tick)
+
+
+    # Adds `liquidity` (negative to remove) to the range [tick_lower, tick_upper);
+    # the ticks must be multiples of the tick spacing
+    def add_liquidity(self, tick_lower, tick_upper, liquidity):
+        assert tick_lower < tick_upper
+        self._update_tick(tick_lower, liquidity, upper=False)
+        self._update_tick(tick_upper, liquidity, upper=True)
+        if tick_lower <= self.tick < tick_upper:
+            self.active_liquidity = max(self.active_liquidity + liquidity, 0.0)
+
+
+    # The ticks of the price range, rounded outwards to the tick spacing
+    def range_to_ticks(self, price_low, price_high):
+        spacing = self.tick_spacing
+        tick_lower = tick_at_sqrt_price(sqrt(price_low)) // spacing * spacing
+        tick_upper = -(-tick_at_sqrt_price(sqrt(price_high)) // spacing) * spacing
+        low, high = self.full_range_ticks()
+        return max(tick_lower, low), min(max(tick_upper, tick_lower + spacing), high)
+
+
+    # Adds a position over the price range [price_low, price_high) worth `value_usd` at the current price;
+    # returns its ticks and its liquidity
+    def add_position_usd(self, price_low, price_high, value_usd):
+        tick_lower, tick_upper = self.range_to_ticks(price_low, price_high)
+        sqrt_lower = sqrt_price_at_tick(tick_lower)
+        sqrt_upper = sqrt_price_at_tick(tick_upper)
+        s = min(max(self.sqrt_price, sqrt_lower), sqrt_upper)
+        # the value of the position with unit liquidity: x * P + y
+        unit_value = (1 / s - 1 / sqrt_upper) * self.price() + (s - sqrt_lower)
+        liquidity = value_usd / unit_value
+        self.add_liquidity(tick_lower, tick_upper, liquidity)
+        return tick_lower, tick_upper, liquidity
+
+
+    def clear_positions(self):
+        self.liquidity_net = {}
+        self.liquidity_gross = {}
+        self.bitmap = TickBitmap(self.tick_spacing)
+        self.active_liquidity = 0.0
+
+
+    # Same as `DEX.set_liquidity_usd`: the price is reset to `ETH_PRICE`,
+    # and the positions are replaced by a single full range position
+    def set_liquidity_usd(self, liquidity_usd):
+        self.clear_positions()
+        self.sqrt_price = sqrt(ETH_PRICE)
+        self.tick = tick_at_sqrt_price(self.sqrt_price)
+        self.add_liquidity(*self.full_range_ticks(), value_to_liquidity(liquidity_usd))
+
+    ############################################################
+    # the state, with the same accessors as `DEX`
+
+    def price(self):
+        return self.sqrt_price * self.sqrt_price
+
+
+    def liquidity(self):
+        return self.active_liquidity
+
+
+    def liquidity_usd(self):
+        return liquidity_to_value(self.active_liquidity)
+
+
+    # the virtual reserves of the active liquidity
+    @property
+    def reserve_x(self):
+        return self.active_liquidity / self.sqrt_price
+
+
+    @property
+    def reserve_y(self):
+        return self.active_liquidity * self.sqrt_price
+
+    ############################################################
+    # the price movement
+
+    # Moves the price up (if `y_in`) or down, until `amount_in` of the input is used
+    # or the sqrt price reaches `sqrt_limit`, crossing the initialized ticks on the way.
+    # The pool's state is not changed: returns `(amount_in_used, amount_out, state)`,
+    # where `state` is the new `(sqrt_price, tick, active_liquidity)` to be passed to `_set_state`.
+    def _move(self, y_in, amount_in, sqrt_limit):
+        s = self.sqrt_price
+        tick = self.tick
+        L = self.active_liquidity
+        next_initialized_tick = self.bitmap.next_initialized_tick
+        liquidity_net = self.liquidity_net
+        remaining = amount_in
+        amount_used = 0.0
+        amount_out = 0.0
+
+        if y_in:
+            while remaining > 0 and s < sqrt_limit:
+                next_tick = next_initialized_tick(tick, False)
+                if next_tick is None:
+                    # no liquidity above
+                    break
+                s_next = sqrt_price_at_tick(next_tick)
+                s_stop = min(s_next, sqrt_limit)
+                if L > 0:
+                    needed = L * (s_stop - s)
+                    if needed > remaining:
+                        s_new = s + remaining / L
+                        used = remaining
+                    else:
+                        s_new = s_stop
+                        used = needed
+                    amount_out += L * (1 / s - 1 / s_new)
+                    amount_used += used
+                    remaining -= used
+                    s = s_new
+                else:
+                    s = s_stop
+                if s >= s_next:
+                    s = s_next
+                    L += liquidity_net[next_tick]
+                    tick = next_tick
+                else:
+                    tick = min(max(tick_at_sqrt_price(s), tick), next_tick - 1)
+                    break
+        else:
+            while remaining > 0 and s > sqrt_limit:
+                next_tick = next_initialized_tick(tick, True)
+                if next_tick is None:
+                    # no liquidity below
+                    break
+                s_next = sqrt_price_at_tick(next_tick)
+                s_stop = max(s_next, sqrt_limit)
+                if L > 0:
+                    needed = L * (1 / s_stop - 1 / s)
+                    if needed > remaining:
+                        s_new = 1 / (1 / s + remaining / L)
+                        used = remaining
+                    else:
+                        s_new = s_stop
+                        used = needed
+                    amount_out += L * (s - s_new)
+                    amount_used += used
+                    remaining -= used
+                    s = s_new
+                else:
+                    s = s_stop
+                if s <= s_next:
+                    s = s_next
+                    L -= liquidity_net[next_tick]
+                    tick = next_tick - 1
+                else:
+                    tick = max(min(tick_at_sqrt_price(s), tick), next_tick)
+                    break
+
+        return amount_used, amount_out, (s, tick, max(L, 0.0))
+
+
+    def _set_state(self, state):
+        self.sqrt_price, self.tick, self.active_liquidity = state
+
+    ############################################################
+    # swaps, as in `DEX`; the fee is taken from the input before it enters the pool
+
+    def swap_x_to_y(self, amount_in_x):
+        price = self.sqrt_price * self.sqrt_price
+        basefee_usd = self.basefee_usd
+
+        # remove the gas fee first
+        amount_in_x -= basefee_usd / price
+        if amount_in_x <= 0:
+            return 0
+
+        amount_in_x_without_fee = amount_in_x / self.fee_factor
+        used, y_out, state = self._move(False, amount_in_x_without_fee, 0.0)
+        if y_out <= 0:
+            return 0
+        if used < amount_in_x_without_fee:
+            # the liquidity ran out: only the used part is taken
+            amount_in_x_without_fee = used
+            amount_in_x = used * self.fee_factor
+        self._set_state(state)
+        self.lp_fees += (amount_in_x - amount_in_x_without_fee) * price
+
+        self.volume += amount_in_x * price
+        self.num_tx += 1
+        self.basefees += basefee_usd
+        return y_out
+
+
+    def swap_y_to_x(self, amount_in_y):
+        basefee_usd = self.basefee_usd
+
+        # remove the gas fee first
+        amount_in_y -= basefee_usd
+        if amount_in_y <= 0:
+            return 0
+
+        amount_in_y_without_fee = amount_in_y / self.fee_factor
+        used, x_out, state = self._move(True, amount_in_y_without_fee, float("inf"))
+        if x_out <= 0:
+            return 0
+        if used < amount_in_y_without_fee:
+            amount_in_y_without_fee = used
+            amount_in_y = used * self.fee_factor
+        self._set_state(state)
+        self.lp_fees += amount_in_y - amount_in_y_without_fee
+
+        self.volume += amount_in_y
+        self.num_tx += 1
+        self.basefees += basefee_usd
+        return x_out
+
+
+    # see `DEX.swap_many`; the swaps are executed one by one
+    def swap_many(self, trade_amounts, cex_price):
+        for trade_amount in trade_amounts:
+            if trade_amount < 0:
+                self.swap_x_to_y(-trade_amount / cex_price)
+            else:
+                self.swap_y_to_x(trade_amount)
+
+
+    def get_output_x_to_y(self, amount_in_x):
+        amount_in_x -= self.basefee_usd / self.price()
+        if amount_in_x <= 0:
+            return 0
+        return self._move(False, amount_in_x / self.fee_factor, 0.0)[1]
+
+
+    def get_output_y_to_x(self, amount_in_y):
+        amount_in_y -= self.basefee_usd
+        if amount_in_y <= 0:
+            return 0
+        return self._move(True, amount_in_y / self.fee_factor, float("inf"))[1]
+
+    ############################################################
+    # arbitrage, as in `DEX`
+
+    def get_target_price(self, cex_price):
+        dex_price = self.price()
+        if cex_price > dex_price:
+            target_price = cex_price / self.fee_factor
+            if target_price < dex_price:
+                return None
+        else:
+            target_price = cex_price * self.fee_factor
+            if target_price > dex_price:
+                return None
+        return target_price
+
+
+    def get_non_arbitrage_region(self):
+        p = self.price()
+        return [p / self.fee_factor, p * self.fee_factor]
+
+
+    # See `DEX.get_no_trade_region`. The formula holds while the active liquidity is constant,
+    # so the region also ends where the target price of the arbitrage reaches the next initialized tick.
+    def get_no_trade_region(self):
+        fee_factor = self.fee_factor
+        tick_up = self.bitmap.next_initialized_tick(self.tick, False)
+        tick_down = self.bitmap.next_initialized_tick(self.tick, True)
+        price_up = sqrt_price_at_tick(tick_up) ** 2 if tick_up is not None else float("inf")
+        price_down = sqrt_price_at_tick(tick_down) ** 2 if tick_down is not None else 0.0
+        price_high = fee_factor * price_up * (1 - 1e-12)
+        price_low = price_down / fee_factor * (1 + 1e-12)
+
+        L = self.active_liquidity
+        if L > 0:
+            sqrt_p = self.sqrt_price
+            basefee = self.basefee_usd * 0.999
+            sqrt_high = sqrt_p + sqrt(basefee * sqrt_p / (L * fee_factor))
+            sqrt_low = max(sqrt_p - sqrt(basefee * sqrt_p / L), 0.0)
+            price_high = min(price_high, fee_factor * sqrt_high * sqrt_high * (1 - 1e-12))
+            price_low = max(price_low, sqrt_low * sqrt_low / fee_factor * (1 + 1e-12))
+        return [price_low, price_high]
+
+
+    # The arbitrager moves the price to the target price, crossing the ticks on the way;
+    # the amounts are those of all the liquidity ranges that the price passes through
+    def maybe_arbitrage(self, cex_price, account_lvr=True):
+        fee_factor = self.fee_factor
+        dex_price = self.sqrt_price * self.sqrt_price
+        if cex_price > dex_price:
+            target_price = cex_price / fee_factor
+            if target_price < dex_price:
+                # the trade does not happen because the CEX/DEX price difference is below the LP fee
+                return False
+            amount_in, amount_out, state = self._move(True, float("inf"), sqrt(target_price))
+            delta_x = -amount_out
+            delta_y = amount_in
+        else:
+            target_price = cex_price * fee_factor
+            if target_price > dex_price:
+                return False
+            amount_in, amount_out, state = self._move(False, float("inf"), sqrt(target_price))
+            delta_x = amount_in
+            delta_y = -amount_out
+
+        # compute the LP fees using CEX prices
+        if delta_x > 0:
+            lp_fee = (delta_x * fee_factor - delta_x) * cex_price
+        else:
+            lp_fee = delta_y * fee_factor - delta_y
+
+        single_transaction_lvr = -(delta_x * cex_price + delta_y)
+        basefee_usd = self.basefee_usd
+        sbp_profit = single_transaction_lvr - lp_fee - basefee_usd
+        if sbp_profit <= 0.0:
+            # the trade does not happen due to the friction from the blockchain base fee
+            return False
+
+        # trade happens; first update the pool's state
+        self._set_state(state)
+
+        # then update the cumulative metrics
+        volume = abs(delta_y) + lp_fee
+        self.volume += volume
+        self.lp_fees += lp_fee
+        self.basefees += basefee_usd
+        self.num_tx += 1
+        # if this was backrun or sandwich, ignore any hypothetical LVR
+        if account_lvr:
+            self.volume_arb += volume
+            self.lp_fees_arb += lp_fee
+            self.lvr += single_transaction_lvr
+            self.sbp_profits += sbp_profit
+
+        return True
@@ -12,6 +12,11 @@ POOL_LIQUIDITY_USD = 100_000_000
 
 # LP fee, in parts per million (pips)
 POOL_FEE_PIPS = 500 # corresponds to 0.05%
+POOL_FEE_FACTOR = 1_000_000 / (1_000_000 - POOL_FEE_PIPS)
+
+# the non-arbitrage region of a new pool, which starts at `ETH_PRICE`:
+# the same as `DEX().get_non_arbitrage_region()`, without creating a pool
+INITIAL_NON_ARBITRAGE_REGION = [ETH_PRICE / POOL_FEE_FACTOR, ETH_PRICE * POOL_FEE_FACTOR]
 
 # For simplicity, assume no gas fees
 
@@ -21,6 +26,12 @@ DEFAULT_BASEFEE_USD = 0.1
 ############################################################
 
 class DEX:
+    # the attributes are in slots: this makes the objects smaller and the attribute access faster
+    __slots__ = ("fee_pips", "fee_factor", "basefee_usd", "block_time_sec",
+                 "reserve_x", "reserve_y",
+                 "volume", "volume_arb", "lp_fees", "lp_fees_arb", "lvr", "sbp_profits", "basefees", "num_tx",
+                 "preset_target_price")
+
     def __init__(self, pool_liquidity_usd=POOL_LIQUIDITY_USD):
 
         POOL_RESERVES_USD = POOL_LIQUIDITY_USD / 2
@@ -45,7 +56,6 @@ class DEX:
         self.basefees = 0
         self.num_tx = 0
         # debugging
-        self.debug_log = False
         self.preset_target_price = None
 
 
@@ -103,48 +113,112 @@ class DEX:
         return delta_y
 
 
+    # the swap and arbitrage functions read the attributes into local variables once
+    # and compute the price inline; the arithmetic is the same as with `price()` and `liquidity()`
     def swap_x_to_y(self, amount_in_x):
-        price = self.price()
+        reserve_y = self.reserve_y
+        price = reserve_y / self.reserve_x
+        basefee_usd = self.basefee_usd
 
         # remove the gas fee first
-        amount_in_x -= self.basefee_usd / price
+        amount_in_x -= basefee_usd / price
         if amount_in_x <= 0:
             return 0
 
         amount_in_x_without_fee = amount_in_x / self.fee_factor
         self.lp_fees += (amount_in_x - amount_in_x_without_fee) * price
-        self.reserve_x += amount_in_x_without_fee
-        y_out = amount_in_x_without_fee * self.reserve_y / self.reserve_x
-        self.reserve_y -= y_out
+        reserve_x = self.reserve_x + amount_in_x_without_fee
+        y_out = amount_in_x_without_fee * reserve_y / reserve_x
+        self.reserve_x = reserve_x
+        self.reserve_y = reserve_y - y_out
 
         self.volume += amount_in_x * price
         self.num_tx += 1
-        self.basefees += self.basefee_usd
-        if self.debug_log:
-            print("swap x to y", y_out)
+        self.basefees += basefee_usd
         return y_out
 
 
     def swap_y_to_x(self, amount_in_y):
+        basefee_usd = self.basefee_usd
+
         # remove the gas fee first
-        amount_in_y -= self.basefee_usd
+        amount_in_y -= basefee_usd
         if amount_in_y <= 0:
             return 0
 
         amount_in_y_without_fee = amount_in_y / self.fee_factor
         self.lp_fees += amount_in_y - amount_in_y_without_fee
-        self.reserve_y += amount_in_y_without_fee
-        x_out = amount_in_y_without_fee * self.reserve_x / self.reserve_y
-        self.reserve_x -= x_out
+        reserve_x = self.reserve_x
+        reserve_y = self.reserve_y + amount_in_y_without_fee
+        x_out = amount_in_y_without_fee * reserve_x / reserve_y
+        self.reserve_y = reserve_y
+        self.reserve_x = reserve_x - x_out
 
         self.volume += amount_in_y
         self.num_tx += 1
-        self.basefees += self.basefee_usd
-        if self.debug_log:
-            print("swap y to x", amount_in_y)
+        self.basefees += basefee_usd
         return x_out
 
 
+    # Executes the noise trades `trade_amounts` (in USD; negative amounts are sells of X,
+    # see `simulation.build_trade_schedule`) one after another at the CEX price `cex_price`,
+    # with the pool's state and the metrics kept in local variables until the end.
+    # The swaps keep the product of the reserves, and the accounting of a swap of Y to X
+    # does not depend on the pool's state, so a run of consecutive buys is applied
+    # as one reserve update. The sells need the price before each swap (for the base fee in X
+    # and for the fees in USD), so they are applied one by one, as in `swap_x_to_y`.
+    # The results are the same as with `swap_x_to_y` and `swap_y_to_x`, up to rounding.
+    def swap_many(self, trade_amounts, cex_price):
+        reserve_x = self.reserve_x
+        reserve_y = self.reserve_y
+        fee_factor = self.fee_factor
+        basefee_usd = self.basefee_usd
+        lp_fees = 0.0
+        volume = 0.0
+        num_tx = 0
+        # the buys not yet applied to the reserves, after the base fee and the LP fee
+        pending_y = 0.0
+        for trade_amount in trade_amounts:
+            if trade_amount > 0:
+                amount_in_y = trade_amount - basefee_usd
+                if amount_in_y <= 0:
+                    continue
+                amount_in_y_without_fee = amount_in_y / fee_factor
+                lp_fees += amount_in_y - amount_in_y_without_fee
+                pending_y += amount_in_y_without_fee
+                volume += amount_in_y
+                num_tx += 1
+                continue
+
+            if pending_y:
+                new_reserve_y = reserve_y + pending_y
+                reserve_x -= pending_y * reserve_x / new_reserve_y
+                reserve_y = new_reserve_y
+                pending_y = 0.0
+            price = reserve_y / reserve_x
+            amount_in_x = -trade_amount / cex_price - basefee_usd / price
+            if amount_in_x <= 0:
+                continue
+            amount_in_x_without_fee = amount_in_x / fee_factor
+            lp_fees += (amount_in_x - amount_in_x_without_fee) * price
+            new_reserve_x = reserve_x + amount_in_x_without_fee
+            reserve_y -= amount_in_x_without_fee * reserve_y / new_reserve_x
+            reserve_x = new_reserve_x
+            volume += amount_in_x * price
+            num_tx += 1
+
+        if pending_y:
+            new_reserve_y = reserve_y + pending_y
+            reserve_x -= pending_y * reserve_x / new_reserve_y
+            reserve_y = new_reserve_y
+        self.reserve_x = reserve_x
+        self.reserve_y = reserve_y
+        self.lp_fees += lp_fees
+        self.volume += volume
+        self.num_tx += num_tx
+        self.basefees += num_tx * basefee_usd
+
+
     def get_output_x_to_y(self, amount_in_x):
         # remove the gas fee first
         amount_in_x -= self.basefee_usd / self.price()
@@ -186,49 +260,73 @@ class DEX:
         return [p / self.fee_factor, p * self.fee_factor]
 
 
+    # The CEX price range in which `maybe_arbitrage` certainly does not trade.
+    # Unlike `get_non_arbitrage_region`, this includes the base fee:
+    # for the target price t and the DEX price p, the arbitrager's profit is
+    #   L * f * (sqrt(t) - sqrt(p))^2 / sqrt(p) - basefee
+    # where f is the fee factor when the CEX price is above the DEX price, and 1 otherwise.
+    # The region is computed for a slightly smaller base fee and slightly shrunk,
+    # so that rounding errors cannot make a trade happen inside it.
+    def get_no_trade_region(self):
+        p = self.price()
+        sqrt_p = sqrt(p)
+        L = self.liquidity()
+        basefee = self.basefee_usd * 0.999
+        sqrt_high = sqrt_p + sqrt(basefee * sqrt_p / (L * self.fee_factor))
+        sqrt_low = max(sqrt_p - sqrt(basefee * sqrt_p / L), 0.0)
+        price_high = self.fee_factor * sqrt_high * sqrt_high * (1 - 1e-12)
+        price_low = sqrt_low * sqrt_low / self.fee_factor * (1 + 1e-12)
+        return [price_low, price_high]
+
+
     def maybe_arbitrage(self, cex_price, account_lvr=True):
-        target_price = self.get_target_price(cex_price)
-        #print(cex_price, target_price)
-        if target_price is None:
-            # the trade does not happen because the CEX/DEX price difference is below the LP fee
-            return False
+        reserve_x = self.reserve_x
+        reserve_y = self.reserve_y
+        fee_factor = self.fee_factor
+
+        # same as `get_target_price`
+        dex_price = reserve_y / reserve_x
+        if cex_price > dex_price:
+            target_price = cex_price / fee_factor
+            if target_price < dex_price:
+                # the trade does not happen because the CEX/DEX price difference is below the LP fee
+                return False
+        else:
+            target_price = cex_price * fee_factor
+            if target_price > dex_price:
+                return False
+
+        # same as `get_amounts_to_target_price`
+        if self.preset_target_price is not None:
+            target_price = self.preset_target_price
+        sqrt_target_price = sqrt(target_price)
+        L = sqrt(reserve_x * reserve_y)
+        delta_x = L / sqrt_target_price - reserve_x
+        delta_y = L * sqrt_target_price - reserve_y
 
-        delta_x, delta_y = self.get_amounts_to_target_price(target_price)
         # compute the LP fees using CEX prices
         # the assumption here is that LPs do not accumulate or compound their fees, but withdraw and rapidly convert to USD
         if delta_x > 0:
-            delta_x_with_fee = delta_x * self.fee_factor
-            delta_y_with_fee = delta_y
-            lp_fee = (delta_x_with_fee - delta_x) * cex_price
+            lp_fee = (delta_x * fee_factor - delta_x) * cex_price
         else:
-            delta_x_with_fee = delta_x
-            delta_y_with_fee = delta_y * self.fee_factor
-            lp_fee = delta_y_with_fee - delta_y
+            lp_fee = delta_y * fee_factor - delta_y
 
         single_transaction_lvr = -(delta_x * cex_price + delta_y)
-        sbp_profit = single_transaction_lvr - lp_fee - self.basefee_usd
+        basefee_usd = self.basefee_usd
+        sbp_profit = single_transaction_lvr - lp_fee - basefee_usd
         if sbp_profit <= 0.0:
             # the trade does not happen due to the friction from the blockchain base fee 
-            if self.debug_log:
-                print("sbp_profit <= 0.0:", single_transaction_lvr, lp_fee, sbp_profit)
             return False
 
         # trade happens; first update the pool's state
-        if self.debug_log:
-            new_reserve_x = self.reserve_x + delta_x
-            new_reserve_y = self.reserve_y + delta_y
-            lp_loss_vs_lvr = (single_transaction_lvr - lp_fee) / single_transaction_lvr
-            print(f" DEX price: {self.reserve_y/self.reserve_x:.4f}->{new_reserve_y/new_reserve_x:.4f} CEX price: {cex_price:.4f} LP fee={lp_fee:.2f} LVR={single_transaction_lvr:.2f} loss: {100*lp_loss_vs_lvr:.1f}%")
-
-        dex_price = self.reserve_y / self.reserve_x
-        self.reserve_x += delta_x
-        self.reserve_y += delta_y
+        self.reserve_x = reserve_x + delta_x
+        self.reserve_y = reserve_y + delta_y
 
         # then update the cumulative metrics
         volume = abs(delta_y) + lp_fee
         self.volume += volume
         self.lp_fees += lp_fee
-        self.basefees += self.basefee_usd
+        self.basefees += basefee_usd
         self.num_tx += 1
         # if this was backrun or sandwich, ignore any hypothetical LVR
         if account_lvr:
@@ -238,4 +336,3 @@ class DEX:
             self.sbp_profits += sbp_profit
 
         return True
-
@@ -0,0 +1,148 @@
+#
+# This file evaluates the Cartesian product of the pool and market parameters
+# (fee tier x base fee x volatility x liquidity) on the same simulations.
+#
+# The pools of a grid point differ from each other only by their parameters, so they
+# run together in `batch.estimate_performance_batch`, in batches of at most `max_batch_pools` pools:
+#  - all fee tiers, base fees and liquidity levels share the price paths of a volatility
+#    and the noise trade sets (from a `TradeStore`);
+#  - the price paths of all volatilities are built from the same normal numbers,
+#    so only the scale of the moves differs between them.
+# The initial prices are uniformly distributed in the non-arbitrage region of the lowest fee tier,
+# which is inside the regions of all the others, so no pool starts with an arbitrage opportunity.
+#
+# The results come back as a `GridResult`: an N-D array with the axes labeled by their values.
+#
+
+from math import sqrt
+import numpy as np
+from common import *
+from batch import estimate_performance_batch
+from trade_store import TradeStore
+
+############################################################
+
+GRID_SEED = 123456
+
+# the pools in a batch; bounds the size of the noise trade schedule in memory
+GRID_MAX_BATCH_POOLS = 1024
+
+GRID_AXES = ("fee_bps", "basefee_usd", "volatility", "liquidity_usd")
+GRID_METRICS = ("lvr", "lp_fees", "lp_fees_arb", "volume", "volume_arb")
+
+
+class GridResult:
+    def __init__(self, axes, values):
+        # the labels of each axis of `values`, in order
+        self.axes = {name: np.asarray(labels) for name, labels in axes.items()}
+        self.values = values
+
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+
+    # Selects the entries with the given labels, e.g. `sel(fee_bps=5, metric="lvr")`;
+    # the selected axes are dropped
+    def sel(self, **labels):
+        index = []
+        axes = {}
+        for name, axis_labels in self.axes.items():
+            if name in labels:
+                matches = np.flatnonzero(axis_labels == labels[name])
+                if len(matches) == 0:
+                    raise KeyError(f"{labels[name]!r} is not on the axis {name}")
+                index.append(matches[0])
+            else:
+                index.append(slice(None))
+                axes[name] = axis_labels
+        return GridResult(axes, self.values[tuple(index)])
+
+
+    # The mean over an axis, e.g. over the simulations
+    def mean(self, name="sim"):
+        axis = list(self.axes).index(name)
+        axes = {k: v for k, v in self.axes.items() if k != name}
+        return GridResult(axes, self.values.mean(axis=axis))
+
+
+    def save(self, filename):
+        np.savez(filename, values=self.values, axis_names=np.array(list(self.axes)),
+                 **{f"axis_{name}": labels for name, labels in self.axes.items()})
+
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as data:
+            axes = {str(name): data[f"axis_{name}"] for name in data["axis_names"]}
+            return GridResult(axes, data["values"])
+
+############################################################
+
+def volatility_per_block(volatility):
+    return volatility / sqrt(365 * 24 * 60 * 60) * sqrt(BLOCK_TIME_SEC)
+
+
+# Returns the price paths of shape (n, M) for the annualized `volatility`, without drift.
+# The normal numbers and the initial prices depend only on `seed`, so the paths of different
+# volatilities are driven by the same numbers. The initial prices are uniform in the
+# non-arbitrage region of the fee tier `fee_bps`.
+def get_grid_price_paths(n, volatility, fee_bps, M=NUM_SIMULATIONS, seed=GRID_SEED):
+    # the trade sets come from the seed sequences [seed, sim] (see `TradeStore`), and the first
+    # of them draws the same numbers as `seed` alone, so the paths use a child of `seed`
+    rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(1)[0])
+    fee_factor = 1_000_000 / (1_000_000 - fee_bps * 100)
+    initial_prices = rng.uniform(1 / fee_factor, fee_factor, M)
+    sigma = volatility_per_block(volatility)
+    prices = np.empty((n, M))
+    for sim in range(M):
+        increments = rng.standard_normal(n - 1)
+        increments *= sigma
+        increments -= sigma ** 2 / 2
+        np.exp(increments, out=increments)
+        prices[0, sim] = ETH_PRICE * initial_prices[sim]
+        prices[1:, sim] = increments
+        np.cumprod(prices[:, sim], out=prices[:, sim])
+    return prices
+
+############################################################
+
+# Runs the simulations of the grid `fee_bps x basefee_usd x volatility x liquidity_usd`
+# (each a list of values) on M price paths of n blocks.
+# With `noise=True`, each simulation index replays the same noise trade set at every grid point.
+# Returns a `GridResult` with the axes `GRID_AXES`, "sim" and "metric" (see `GRID_METRICS`).
+def run_grid(fee_bps, basefee_usd, volatility, liquidity_usd, n=SIMULATION_DURATION_BLOCKS, M=NUM_SIMULATIONS,
+             seed=GRID_SEED, noise=True, trade_store=None, max_batch_pools=GRID_MAX_BATCH_POOLS):
+    axes = {"fee_bps": fee_bps, "basefee_usd": basefee_usd, "volatility": volatility,
+            "liquidity_usd": liquidity_usd, "sim": np.arange(M), "metric": np.array(GRID_METRICS)}
+    values = np.zeros(tuple(len(labels) for labels in axes.values()))
+
+    if noise:
+        if trade_store is None:
+            trade_store = TradeStore()
+        duration_days = n * BLOCK_TIME_SEC / 86400
+        trades = [trade_store.get(seed, sim, duration_days) for sim in range(M)]
+
+    # the pools of a volatility: every (fee, basefee, liquidity, sim), in the order of the result axes
+    fee_index, basefee_index, liquidity_index, sims = np.meshgrid(
+        np.arange(len(fee_bps)), np.arange(len(basefee_usd)), np.arange(len(liquidity_usd)), np.arange(M),
+        indexing="ij")
+    fee_index, basefee_index, liquidity_index, sims = (a.ravel() for a in (fee_index, basefee_index, liquidity_index, sims))
+    pool_fee_bps = np.asarray(fee_bps, dtype=float)[fee_index]
+    pool_basefee_usd = np.asarray(basefee_usd, dtype=float)[basefee_index]
+    pool_liquidity_usd = np.asarray(liquidity_usd, dtype=float)[liquidity_index]
+
+    for v, vol in enumerate(volatility):
+        print(f"volatility={vol}")
+        all_prices = get_grid_price_paths(n, vol, min(fee_bps), M, seed)
+        for start in range(0, len(sims), max_batch_pools):
+            batch = slice(start, start + max_batch_pools)
+            metrics = estimate_performance_batch(
+                all_prices,
+                [trades[sim] for sim in sims[batch]] if noise else None,
+                pool_liquidity_usd[batch], paths=sims[batch],
+                fee_bps=pool_fee_bps[batch], basefee_usd=pool_basefee_usd[batch])
+            values[fee_index[batch], basefee_index[batch], v, liquidity_index[batch], sims[batch]] = np.array(metrics).T
+
+    return GridResult(axes, values)
@@ -0,0 +1,182 @@
+#
+# This file has compiled versions of the DEX swap and arbitrage functions.
+# The pools' state is a 2D array with one row per field and one column per pool.
+# The arithmetic mirrors `dex.DEX` operation by operation.
+# Numba is optional: without it, `HAVE_NUMBA` is False and the simulation
+# falls back to the `DEX` class.
+#
+
+from math import sqrt
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+############################################################
+
+# the rows of the pool state array
+RESERVE_X = 0
+RESERVE_Y = 1
+FEE_FACTOR = 2
+BASEFEE_USD = 3
+VOLUME = 4
+VOLUME_ARB = 5
+LP_FEES = 6
+LP_FEES_ARB = 7
+LVR = 8
+SBP_PROFITS = 9
+BASEFEES = 10
+NUM_TX = 11
+NUM_FIELDS = 12
+
+
+def pool_state_from_dex(dexes):
+    state = np.zeros((NUM_FIELDS, len(dexes)))
+    for j, dex in enumerate(dexes):
+        state[RESERVE_X, j] = dex.reserve_x
+        state[RESERVE_Y, j] = dex.reserve_y
+        state[FEE_FACTOR, j] = dex.fee_factor
+        state[BASEFEE_USD, j] = dex.basefee_usd
+        state[VOLUME, j] = dex.volume
+        state[VOLUME_ARB, j] = dex.volume_arb
+        state[LP_FEES, j] = dex.lp_fees
+        state[LP_FEES_ARB, j] = dex.lp_fees_arb
+        state[LVR, j] = dex.lvr
+        state[SBP_PROFITS, j] = dex.sbp_profits
+        state[BASEFEES, j] = dex.basefees
+        state[NUM_TX, j] = dex.num_tx
+    return state
+
+
+def pool_state_to_dex(state, dexes):
+    for j, dex in enumerate(dexes):
+        dex.reserve_x = state[RESERVE_X, j]
+        dex.reserve_y = state[RESERVE_Y, j]
+        dex.volume = state[VOLUME, j]
+        dex.volume_arb = state[VOLUME_ARB, j]
+        dex.lp_fees = state[LP_FEES, j]
+        dex.lp_fees_arb = state[LP_FEES_ARB, j]
+        dex.lvr = state[LVR, j]
+        dex.sbp_profits = state[SBP_PROFITS, j]
+        dex.basefees = state[BASEFEES, j]
+        dex.num_tx = int(state[NUM_TX, j])
+
+############################################################
+
+@njit(cache=True)
+def swap_x_to_y(state, j, amount_in_x):
+    price = state[RESERVE_Y, j] / state[RESERVE_X, j]
+
+    # remove the gas fee first
+    amount_in_x -= state[BASEFEE_USD, j] / price
+    if amount_in_x <= 0:
+        return 0.0
+
+    amount_in_x_without_fee = amount_in_x / state[FEE_FACTOR, j]
+    state[LP_FEES, j] += (amount_in_x - amount_in_x_without_fee) * price
+    state[RESERVE_X, j] += amount_in_x_without_fee
+    y_out = amount_in_x_without_fee * state[RESERVE_Y, j] / state[RESERVE_X, j]
+    state[RESERVE_Y, j] -= y_out
+
+    state[VOLUME, j] += amount_in_x * price
+    state[NUM_TX, j] += 1
+    state[BASEFEES, j] += state[BASEFEE_USD, j]
+    return y_out
+
+
+@njit(cache=True)
+def swap_y_to_x(state, j, amount_in_y):
+    # remove the gas fee first
+    amount_in_y -= state[BASEFEE_USD, j]
+    if amount_in_y <= 0:
+        return 0.0
+
+    amount_in_y_without_fee = amount_in_y / state[FEE_FACTOR, j]
+    state[LP_FEES, j] += amount_in_y - amount_in_y_without_fee
+    state[RESERVE_Y, j] += amount_in_y_without_fee
+    x_out = amount_in_y_without_fee * state[RESERVE_X, j] / state[RESERVE_Y, j]
+    state[RESERVE_X, j] -= x_out
+
+    state[VOLUME, j] += amount_in_y
+    state[NUM_TX, j] += 1
+    state[BASEFEES, j] += state[BASEFEE_USD, j]
+    return x_out
+
+
+@njit(cache=True)
+def maybe_arbitrage(state, j, cex_price, account_lvr):
+    reserve_x = state[RESERVE_X, j]
+    reserve_y = state[RESERVE_Y, j]
+    fee_factor = state[FEE_FACTOR, j]
+
+    dex_price = reserve_y / reserve_x
+    if cex_price > dex_price:
+        target_price = cex_price / fee_factor
+        if target_price < dex_price:
+            return False
+    else:
+        target_price = cex_price * fee_factor
+        if target_price > dex_price:
+            return False
+
+    sqrt_target_price = sqrt(target_price)
+    L = sqrt(reserve_x * reserve_y)
+    delta_x = L / sqrt_target_price - reserve_x
+    delta_y = L * sqrt_target_price - reserve_y
+    if delta_x > 0:
+        lp_fee = (delta_x * fee_factor - delta_x) * cex_price
+    else:
+        lp_fee = delta_y * fee_factor - delta_y
+
+    single_transaction_lvr = -(delta_x * cex_price + delta_y)
+    sbp_profit = single_transaction_lvr - lp_fee - state[BASEFEE_USD, j]
+    if sbp_profit <= 0.0:
+        return False
+
+    state[RESERVE_X, j] = reserve_x + delta_x
+    state[RESERVE_Y, j] = reserve_y + delta_y
+
+    volume = abs(delta_y) + lp_fee
+    state[VOLUME, j] += volume
+    state[LP_FEES, j] += lp_fee
+    state[BASEFEES, j] += state[BASEFEE_USD, j]
+    state[NUM_TX, j] += 1
+    if account_lvr:
+        state[VOLUME_ARB, j] += volume
+        state[LP_FEES_ARB, j] += lp_fee
+        state[LVR, j] += single_transaction_lvr
+        state[SBP_PROFITS, j] += sbp_profit
+    return True
+
+############################################################
+
+# the block loop of `simulation.estimate_performance` without noise trades
+@njit(cache=True)
+def run_arbitrage_blocks(state, j, prices):
+    for i in range(len(prices)):
+        maybe_arbitrage(state, j, prices[i], True)
+
+
+# the block loop of `simulation.estimate_performance` with noise trades;
+# `prices` starts at the block `first_block` of the schedule `offsets, amounts`
+@njit(cache=True)
+def run_blocks(state, j, prices, first_block, offsets, amounts):
+    for local_i in range(len(prices)):
+        i = first_block + local_i
+        cex_price = prices[local_i]
+        # first execute the arbitrage (may include a backrun)
+        maybe_arbitrage(state, j, cex_price, True)
+        # then execute the noise trades
+        for k in range(offsets[i], offsets[i + 1]):
+            trade_amount = amounts[k]
+            if trade_amount < 0:
+                swap_x_to_y(state, j, -trade_amount / cex_price)
+            else:
+                swap_y_to_x(state, j, trade_amount)
+        # check if backrun can be done in the same block
+        maybe_arbitrage(state, j, cex_price, False)
@@ -0,0 +1,194 @@
+#
+# This file caches the results of simulation runs on disk.
+# A run is identified by a hash of everything its result depends on:
+# the contents of the price path and of the trade set, the liquidity,
+# the DEX and simulation parameters, and the source code of the simulation.
+# So repeated runs, also from different scripts, are only simulated once.
+#
+
+import os
+import importlib
+import hashlib
+import inspect
+from functools import lru_cache
+import numpy as np
+import dex
+import common
+from simulation import PriceStream
+
+############################################################
+
+CACHE_DIR = ".simulation_cache"
+
+# the least recently used results are deleted when the cache grows above this size
+MAX_CACHE_BYTES = 1 << 30
+
+# the modules whose code the results depend on, in addition to the module of the simulation function
+SIMULATION_MODULES = ["common", "dex", "simulation", "routing", "batch", "kernels"]
+
+
+def fingerprint(data):
+    if data is None:
+        return "none"
+    if isinstance(data, PriceStream):
+        return f"stream({data.n},{data.sigma!r},{data.mu!r},{data.seed.entropy},{data.seed.spawn_key},{data.block_size})"
+    data = np.ascontiguousarray(data)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{data.dtype.str}{data.shape}".encode())
+    h.update(data.data)
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def source_fingerprint(filename):
+    with open(filename, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def code_fingerprint(simulate):
+    filenames = [inspect.getsourcefile(importlib.import_module(name)) for name in SIMULATION_MODULES]
+    filenames.append(inspect.getsourcefile(simulate))
+    return ",".join(source_fingerprint(filename) for filename in sorted(set(filenames)))
+
+
+# the parameters are read when the key is computed, so changing them invalidates the cache
+def simulation_key(name, code, prices, trades, liquidity_usd):
+    return simulation_key_from_fingerprints(name, code, fingerprint(prices), fingerprint(trades), liquidity_usd)
+
+
+# the same, with the fingerprints of the price path and of the trades already computed
+def simulation_key_from_fingerprints(name, code, prices_fingerprint, trades_fingerprint, liquidity_usd):
+    # the same liquidity gives the same key whether it is a Python or a NumPy float
+    liquidity_usd = None if liquidity_usd is None else float(liquidity_usd)
+    parameters = (name, code, prices_fingerprint, trades_fingerprint, repr(liquidity_usd),
+                  dex.POOL_FEE_PIPS, dex.DEFAULT_BASEFEE_USD, common.BLOCK_TIME_SEC, common.ETH_PRICE,
+                  common.MAX_PRICE_IMPACT_PCT, common.OTHER_DEX_LIQUDITY_USD)
+    return hashlib.sha256(repr(parameters).encode()).hexdigest()
+
+############################################################
+
+class SimulationCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+
+
+    def filename(self, key):
+        return os.path.join(self.directory, key[:2], key + ".npy")
+
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            result = np.load(filename)
+        except (OSError, ValueError):
+            return None
+        # mark as recently used
+        os.utime(filename)
+        return tuple(result)
+
+
+    def put(self, key, result):
+        filename = self.filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, "wb") as f:
+            np.save(f, np.array(result, dtype=float))
+        os.replace(tmp_filename, filename)
+
+        if self.total_bytes is None:
+            self.total_bytes = sum(size for _, _, size in self.list_files())
+        else:
+            self.total_bytes += os.path.getsize(filename)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+
+    def list_files(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".npy"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    yield stat.st_mtime, path, stat.st_size
+
+
+    # delete the least recently used results until the cache is at 90% of its max size
+    def evict(self):
+        files = sorted(self.list_files())
+        self.total_bytes = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.total_bytes -= size
+
+############################################################
+
+# Wraps `simulate(prices, noise_trades, liquidity_usd)` with a cache.
+# Functions with numerically identical results can share the cache by using the same `name`.
+class Memoized:
+    def __init__(self, simulate, name=None, cache=None):
+        self.simulate = simulate
+        self.__name__ = simulate.__name__
+        self.name = name if name is not None else simulate.__name__
+        self.cache = cache if cache is not None else SimulationCache()
+
+
+    def __call__(self, prices, noise_trades=None, liquidity_usd=None):
+        key = simulation_key(self.name, code_fingerprint(self.simulate), prices, noise_trades, liquidity_usd)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.simulate(prices, noise_trades, liquidity_usd)
+            self.cache.put(key, result)
+        return result
+
+
+# Wraps `batch.estimate_performance_batch` with a cache, one entry per pool.
+# Only the pools that are not in the cache are simulated.
+# As in `estimate_performance_batch`, pool j runs on the price path `paths[j]`
+# (by default, on the column j of `all_prices`).
+class MemoizedBatch:
+    def __init__(self, simulate_batch, name=None, cache=None):
+        self.simulate_batch = simulate_batch
+        self.__name__ = simulate_batch.__name__
+        self.name = name if name is not None else simulate_batch.__name__
+        self.cache = cache if cache is not None else SimulationCache()
+
+
+    def __call__(self, all_prices, noise_trades=None, liquidity_usd=None, paths=None):
+        all_prices = np.asarray(all_prices, dtype=float)
+        if all_prices.ndim == 1:
+            all_prices = all_prices[:,None]
+        paths = np.arange(all_prices.shape[1]) if paths is None else np.asarray(paths)
+        num_pools = len(paths)
+        liquidities = np.broadcast_to(np.asarray(liquidity_usd if liquidity_usd is not None else np.nan, dtype=float), (num_pools,))
+        code = code_fingerprint(self.simulate_batch)
+        # the pools often share price paths and trade sets, so each is hashed once
+        path_fingerprints = {path: fingerprint(all_prices[:,path]) for path in np.unique(paths)}
+        trades_fingerprints = {}
+        keys = []
+        results = []
+        for j in range(num_pools):
+            trades = None if noise_trades is None else noise_trades[j]
+            if id(trades) not in trades_fingerprints:
+                trades_fingerprints[id(trades)] = fingerprint(trades)
+            liquidity = None if liquidity_usd is None else float(liquidities[j])
+            keys.append(simulation_key_from_fingerprints(self.name, code, path_fingerprints[paths[j]],
+                                                         trades_fingerprints[id(trades)], liquidity))
+            results.append(self.cache.get(keys[-1]))
+
+        missing = [j for j in range(num_pools) if results[j] is None]
+        if missing:
+            trades = None if noise_trades is None else [noise_trades[j] for j in missing]
+            liquidity = None if liquidity_usd is None else liquidities[missing]
+            computed = np.array(self.simulate_batch(all_prices, trades, liquidity, paths=paths[missing])).T
+            for j, result in zip(missing, computed):
+                results[j] = tuple(result)
+                self.cache.put(keys[j], results[j])
+
+        return tuple(np.array(u) for u in zip(*results))
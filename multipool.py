@@ -0,0 +1,82 @@
+#
+# This file simulates N competing pools (venues) that share the noise trades,
+# generalizing `simulation.estimate_performance_twopools`.
+# The pools' state is held in a `batch.BatchDEX`, one entry per pool.
+#
+# The noise trades are split between the pools by `routing.optimal_multi_split`,
+# which takes the LP fees and the base fees into account; with two pools,
+# it makes the same choices as the router of `estimate_performance_twopools`.
+#
+
+import numpy as np
+from common import *
+from batch import BatchDEX
+from simulation import build_trade_schedule, find_next_outside
+from routing import optimal_multi_split_x_to_y, optimal_multi_split_y_to_x
+
+############################################################
+
+def route_swap_x_to_y(pools, trade_amount_x):
+    idx, amounts = optimal_multi_split_x_to_y(pools.reserve_x, pools.reserve_y, pools.fee_factor, pools.basefee_usd,
+                                              trade_amount_x)
+    return pools.swap_x_to_y(idx, amounts)
+
+
+def route_swap_y_to_x(pools, trade_amount_y):
+    idx, amounts = optimal_multi_split_y_to_x(pools.reserve_x, pools.reserve_y, pools.fee_factor, pools.basefee_usd,
+                                              trade_amount_y)
+    return pools.swap_y_to_x(idx, amounts)
+
+############################################################
+
+# Simulates the pools with the liquidities `liquidities` (the first one is "my" pool)
+# on a single price path, with the noise trades routed across all of them.
+# As in `estimate_performance_twopools`, the price impact filter uses the total liquidity.
+# The blocks without noise trades where the price is inside the no-trade region
+# of every pool are skipped, since nothing can happen in them.
+# Returns the tuple `(lvr, lp_fees, lp_fees_arb, volume, volume_arb)` of arrays, one entry per pool.
+def estimate_performance_multipool(prices, noise_trades, liquidities):
+    prices = np.asarray(prices)
+    price_list = prices.tolist()
+    n = len(prices)
+    pools = BatchDEX(len(liquidities))
+    pools.set_liquidity_usd(liquidities)
+
+    if noise_trades is None:
+        trade_blocks = []
+    else:
+        max_swap_all = swap_size_from_liquidity(np.sum(pools.liquidity_usd()), MAX_PRICE_IMPACT_PCT / 100)
+        offsets, amounts = build_trade_schedule(noise_trades, n, max_swap_all)
+        trade_blocks = np.flatnonzero(np.diff(offsets)).tolist()
+        offsets = offsets.tolist()
+        amounts = amounts.tolist()
+
+    next_trade = 0
+    i = 0
+    while i < n:
+        # the next block where a noise trade happens or any pool may be arbitraged
+        price_low, price_high = pools.get_no_trade_region()
+        j = find_next_outside(prices, price_list, i, price_low.max(), price_high.min())
+        while next_trade < len(trade_blocks) and trade_blocks[next_trade] < i:
+            next_trade += 1
+        if next_trade < len(trade_blocks):
+            j = min(j, trade_blocks[next_trade])
+        if j >= n:
+            break
+
+        cex_price = price_list[j]
+        # first execute the arbitrage (may include a backrun)
+        pools.maybe_arbitrage(cex_price)
+        if noise_trades is not None:
+            # then execute the noise trades
+            for k in range(offsets[j], offsets[j + 1]):
+                trade_amount = amounts[k]
+                if trade_amount < 0:
+                    route_swap_x_to_y(pools, -trade_amount / cex_price)
+                else:
+                    route_swap_y_to_x(pools, trade_amount)
+        # check if backrun can be done in the same block
+        pools.maybe_arbitrage(cex_price, account_lvr=False)
+        i = j + 1
+
+    return pools.lvr, pools.lp_fees, pools.lp_fees_arb, pools.volume, pools.volume_arb
@@ -0,0 +1,111 @@
+#
+# This file estimates the noise (non-arbitrage) swap volume and LP fees in closed form.
+# The swap sizes are log-normal (see `rng.generate_lognormal_numbers`); a swap executes
+# if its size is at most the max swap size for the pool's liquidity, and the LP fee
+# is charged on the swap amount after the base fee is removed. For a log-normal X,
+#   P(b < X <= m) = Phi(z(m)) - Phi(z(b))
+#   E[X; b < X <= m] = exp(mu + sigma^2 / 2) * (Phi(z(m) - sigma) - Phi(z(b) - sigma))
+# where z(x) = (ln(x) - mu) / sigma.
+#
+
+from math import erf, exp, log, sqrt
+import numpy as np
+from dex import DEX
+from common import *
+from rng import lognormal_parameters
+from simulation import estimate_performance
+
+############################################################
+
+def normal_cdf(x):
+    return 0.5 * (1 + erf(x / sqrt(2)))
+
+
+# The expected number, volume and LP fees of the executed noise swaps
+# out of `num_trades` swaps, in a pool with the given liquidity
+def expected_noise_performance(liquidity_usd, num_trades):
+    dex = DEX()
+    if liquidity_usd is not None:
+        dex.set_liquidity_usd(liquidity_usd)
+    max_swap = swap_size_from_liquidity(dex.liquidity_usd(), MAX_PRICE_IMPACT_PCT / 100)
+    basefee = dex.basefee_usd
+    if max_swap <= basefee:
+        return 0.0, 0.0, 0.0
+
+    mu, sigma = lognormal_parameters()
+    z_max = (log(max_swap) - mu) / sigma
+    z_min = (log(basefee) - mu) / sigma
+    probability = normal_cdf(z_max) - normal_cdf(z_min)
+    partial_mean = exp(mu + sigma ** 2 / 2) * (normal_cdf(z_max - sigma) - normal_cdf(z_min - sigma))
+
+    num_executed = num_trades * probability
+    # the volume is counted after the base fee is removed
+    volume = num_trades * (partial_mean - basefee * probability)
+    lp_fees = volume * (1 - 1 / dex.fee_factor)
+    return num_executed, volume, lp_fees
+
+############################################################
+
+# A `DEX` that also counts the LP fees of the backruns, the arbitrage after the noise trades of a block
+class BackrunCountingDEX(DEX):
+    __slots__ = ("lp_fees_backrun",)
+
+    def __init__(self):
+        super().__init__()
+        self.lp_fees_backrun = 0
+
+
+    def maybe_arbitrage(self, cex_price, account_lvr=True):
+        if account_lvr:
+            return super().maybe_arbitrage(cex_price)
+        lp_fees = self.lp_fees
+        traded = super().maybe_arbitrage(cex_price, account_lvr=False)
+        self.lp_fees_backrun += self.lp_fees - lp_fees
+        return traded
+
+############################################################
+
+# Same as `estimate_performance`, but only the arbitrage is simulated;
+# the noise volume and LP fees are added from the closed-form estimate.
+# `noise_trades` is only used for the number of trades.
+# The estimate misses the effect of the noise trades on the arbitrage: the LP fees of the
+# backruns are not included, and they are a large part of the non-arbitrage LP fees
+# (see `compare_noise_estimate`), so the total LP fees are underestimated.
+def estimate_performance_analytical(prices, noise_trades=None, liquidity_usd=None):
+    lvr, lp_fees, lp_fees_arb, volume, volume_arb = estimate_performance(prices, None, liquidity_usd)
+    if noise_trades is not None:
+        num_trades = noise_trades if np.ndim(noise_trades) == 0 else len(noise_trades)
+        _, noise_volume, noise_lp_fees = expected_noise_performance(liquidity_usd, num_trades)
+        lp_fees += noise_lp_fees
+        volume += noise_volume
+    return lvr, lp_fees, lp_fees_arb, volume, volume_arb
+
+
+# Compares the closed-form LP fees of the noise swaps with the simulated ones at each
+# liquidity level, averaged over the given price paths and trade sets.
+# The simulated non-arbitrage LP fees `lp_fees - lp_fees_arb` are split into the fees of the
+# noise swaps, which the estimate models, and the fees of their backruns, which it does not.
+# Returns the arrays `(estimated, simulated, relative_error, backrun)`: the estimated and simulated
+# LP fees of the noise swaps, the relative error of the estimate, and the simulated LP fees of the backruns.
+def compare_noise_estimate(all_prices, all_trades, liquidities):
+    num_sims = all_prices.shape[1]
+    estimated = np.zeros(len(liquidities))
+    simulated = np.zeros(len(liquidities))
+    backrun = np.zeros(len(liquidities))
+    for level, liquidity_usd in enumerate(liquidities):
+        total_lp_fees = 0.0
+        for sim in range(num_sims):
+            dex = BackrunCountingDEX()
+            dex.set_liquidity_usd(liquidity_usd)
+            _, lp_fees, lp_fees_arb, _, _ = estimate_performance(all_prices[:,sim], all_trades[sim], dex=dex)
+            simulated[level] += (lp_fees - lp_fees_arb - dex.lp_fees_backrun) / num_sims
+            backrun[level] += dex.lp_fees_backrun / num_sims
+            total_lp_fees += lp_fees / num_sims
+            _, _, noise_lp_fees = expected_noise_performance(liquidity_usd, len(all_trades[sim]))
+            estimated[level] += noise_lp_fees / num_sims
+        print(f"liquidity_usd={liquidity_usd:.0f} noise swap LP fees: estimated={estimated[level]:.2f} simulated={simulated[level]:.2f}"
+              f" backrun LP fees: {backrun[level]:.2f} ({100 * backrun[level] / total_lp_fees:.1f}% of the total LP fees)")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative_error = np.where(simulated != 0, (estimated - simulated) / simulated, 0.0)
+    return estimated, simulated, relative_error, backrun
@@ -0,0 +1,102 @@
+#
+# This file has opt-in instrumentation for the simulations: counters of what the
+# DEX and the block loop did, and optionally the time spent in each phase.
+# The plain `DEX` class and the simulation loops are not instrumented, so without
+# a `Profile` there is no overhead; with one, `ProfiledDEX` and the profiled block
+# loop in `simulation.py` are used instead.
+#
+
+from collections import Counter
+from time import perf_counter_ns
+from dex import DEX
+
+############################################################
+
+class Profile:
+    def __init__(self, timing=False):
+        # also measure the time of each phase; costs a few clock reads per block
+        self.timing = timing
+        self.counters = Counter()
+        self.times_ns = Counter()
+
+
+    def count(self, name, k=1):
+        self.counters[name] += k
+
+
+    def add_time(self, name, time_ns):
+        self.times_ns[name] += time_ns
+
+
+    def merge(self, other):
+        self.counters.update(other.counters)
+        self.times_ns.update(other.times_ns)
+
+
+    def as_dict(self):
+        result = dict(self.counters)
+        for name, time_ns in self.times_ns.items():
+            result[f"{name}_ns"] = time_ns
+        return result
+
+
+    def report(self):
+        lines = [f"{name:40} {value}" for name, value in sorted(self.counters.items())]
+        total_ns = sum(self.times_ns.values())
+        for name, time_ns in sorted(self.times_ns.items(), key=lambda u: -u[1]):
+            lines.append(f"{name + ' time':40} {time_ns / 1e6:.1f} ms ({100 * time_ns / max(total_ns, 1):.1f}%)")
+        return "\n".join(lines)
+
+############################################################
+
+# A `DEX` that counts the calls and their outcomes in `profile`
+class ProfiledDEX(DEX):
+    __slots__ = ("profile",)
+
+    def __init__(self, profile):
+        super().__init__()
+        self.profile = profile
+
+
+    def maybe_arbitrage(self, cex_price, account_lvr=True):
+        profile = self.profile
+        profile.count("arbitrage_calls")
+        if super().maybe_arbitrage(cex_price, account_lvr):
+            profile.count("arbitrage_trades" if account_lvr else "backrun_trades")
+            return True
+        # the price is unchanged, so the reason can be checked afterwards
+        if self.get_target_price(cex_price) is None:
+            profile.count("arbitrage_inside_fee_band")
+        else:
+            profile.count("arbitrage_below_basefee")
+        return False
+
+
+    def swap_x_to_y(self, amount_in_x):
+        y_out = super().swap_x_to_y(amount_in_x)
+        self.profile.count("swaps_x_to_y" if y_out else "swaps_below_basefee")
+        return y_out
+
+
+    def swap_y_to_x(self, amount_in_y):
+        x_out = super().swap_y_to_x(amount_in_y)
+        self.profile.count("swaps_y_to_x" if x_out else "swaps_below_basefee")
+        return x_out
+
+
+# Measures the time of a phase: `with timer(profile, "noise"): ...`
+class timer:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+
+    def __enter__(self):
+        if self.profile is not None and self.profile.timing:
+            self.start = perf_counter_ns()
+        return self
+
+
+    def __exit__(self, *args):
+        if self.profile is not None and self.profile.timing:
+            self.profile.add_time(self.name, perf_counter_ns() - self.start)
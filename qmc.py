@@ -0,0 +1,168 @@
+#
+# This file generates the price paths with quasi-Monte Carlo: scrambled Sobol points
+# mapped to normal numbers, with each path built by a Brownian bridge.
+# `get_qmc_price_paths` is a drop-in alternative to `simulation.get_price_paths`.
+#
+# The bridge first sets the end of the path, then the middle, then the quarters, and so on,
+# so the first dimensions of the Sobol points decide the shape of the path at large scales,
+# where most of its variance is. A path has one dimension per block, far more than
+# the Sobol points can usefully cover, so only the first `bridge_dims` bridge points
+# use the Sobol points and the rest use pseudo-random normals (a hybrid QMC scheme).
+# The first Sobol dimension sets the initial price in the pool's non-arbitrage region.
+#
+# The balance properties of the Sobol points need the number of paths M to be a power of 2;
+# any other M (e.g. the default `NUM_SIMULATIONS` = 40) works, with the first M points of the sequence,
+# but it gives less variance reduction.
+# SciPy is optional: without it, `HAVE_SCIPY` is False and only `simulation.get_price_paths` works.
+#
+# Run `python qmc.py` to compare the convergence of the mean LVR and LP fees
+# with the two generators.
+#
+
+import argparse
+import numpy as np
+from common import *
+from dex import INITIAL_NON_ARBITRAGE_REGION
+from simulation import get_price_paths, PRICE_PATH_CHUNK_SIZE
+
+try:
+    from scipy.stats import qmc
+    from scipy.special import ndtri
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+# the number of bridge points (from the coarsest) that use the Sobol points
+QMC_BRIDGE_DIMENSIONS = 64
+
+############################################################
+
+# Returns the bridge construction steps for the points 1..num_steps - 1 of a path, in order,
+# after the last point. Each step is a tuple `(points, left, right)` of arrays:
+# the points are set from the already known values at `left` and `right`.
+def brownian_bridge_steps(num_steps):
+    steps = []
+    left = np.array([0])
+    right = np.array([num_steps])
+    while len(left):
+        keep = right - left >= 2
+        left, right = left[keep], right[keep]
+        middle = (left + right) // 2
+        if len(middle):
+            steps.append((middle, left, right))
+        left, right = np.concatenate([left, middle]), np.concatenate([middle, right])
+    return steps
+
+
+# Fills `w` of shape (num_steps + 1, num_paths) with standard Brownian paths (unit variance per step),
+# taking the normal numbers of the bridge points in order from the rows of `normals`.
+def brownian_bridge(w, normals):
+    num_steps = len(w) - 1
+    w[0] = 0
+    w[num_steps] = np.sqrt(num_steps) * normals[0]
+    k = 1
+    for points, left, right in brownian_bridge_steps(num_steps):
+        z = normals[k:k + len(points)]
+        k += len(points)
+        span = (right - left)[:,None]
+        a = (points - left)[:,None]
+        b = (right - points)[:,None]
+        w[points] = (b * w[left] + a * w[right]) / span + np.sqrt(a * b / span) * z
+    return w
+
+############################################################
+
+# Returns an array of shape (n, M) with one price path per column, as `simulation.get_price_paths`.
+# The scrambling of the Sobol points and the pseudo-random normals are drawn from NumPy's global
+# random state, so the paths are reproducible with `np.random.seed`.
+def get_qmc_price_paths(n, sigma, mu, M=NUM_SIMULATIONS, dtype=np.float64, filename=None,
+                        chunk_size=PRICE_PATH_CHUNK_SIZE, bridge_dims=QMC_BRIDGE_DIMENSIONS):
+    if not HAVE_SCIPY:
+        raise ImportError("the QMC price paths need SciPy (scipy.stats.qmc)")
+    if filename is None:
+        St = np.empty((n, M), dtype=dtype)
+    else:
+        # in Fortran order, as in `simulation.get_price_paths`
+        St = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=(n, M), fortran_order=True)
+    num_steps = n - 1
+    bridge_dims = min(bridge_dims, num_steps)
+
+    sobol = qmc.Sobol(1 + bridge_dims, scramble=True, seed=np.random.randint(2 ** 31))
+    # the first M points of the sequence, drawn as the next power of 2 of them:
+    # `sobol.random(M)` gives the same points, but warns when M is not a power of 2
+    points = sobol.random_base2((M - 1).bit_length())[:M]
+    # the scrambled points are never exactly 0 or 1, but keep the normals finite anyway
+    points = np.clip(points, 1e-12, 1 - 1e-12)
+
+    price_low, price_high = INITIAL_NON_ARBITRAGE_REGION
+    initial_prices = price_low / ETH_PRICE + points[:,0] * (price_high - price_low) / ETH_PRICE
+    sobol_normals = ndtri(points[:,1:]).T
+
+    drift = (mu - sigma ** 2 / 2) * np.arange(n)[:,None]
+    for start in range(0, M, chunk_size):
+        end = min(start + chunk_size, M)
+        normals = np.empty((num_steps, end - start))
+        normals[:bridge_dims] = sobol_normals[:,start:end]
+        normals[bridge_dims:] = np.random.normal(0, 1, size=(end - start, num_steps - bridge_dims)).T
+        w = brownian_bridge(np.empty((n, end - start)), normals)
+        w *= sigma
+        w += drift
+        np.exp(w, out=w)
+        w *= ETH_PRICE * initial_prices[start:end]
+        St[:, start:end] = w
+        del normals, w
+
+    if filename is not None:
+        St.flush()
+    return St
+
+############################################################
+
+GENERATORS = {
+    "mc": get_price_paths,
+    "qmc": get_qmc_price_paths,
+}
+
+CONVERGENCE_DURATION_DAYS = 1
+CONVERGENCE_PATHS = (8, 16, 32, 64, 128)
+CONVERGENCE_REPEATS = 16
+CONVERGENCE_LIQUIDITY_USD = 1e6
+CONVERGENCE_SEED = 123456
+
+# The mean LVR and LP fees over M paths, for `repeats` independent sets of M paths
+# (independent scramblings for QMC). The arbitrage-only simulation is used,
+# so that the variance comes from the price paths alone.
+def sample_means(generator, n, M, repeats, liquidity_usd):
+    from batch import estimate_performance_batch
+    all_prices = np.hstack([generator(n, ETH_VOLATILITY_PER_BLOCK, 0.0, M) for _ in range(repeats)])
+    lvr, lp_fees, *_ = estimate_performance_batch(all_prices, None, liquidity_usd)
+    return lvr.reshape(repeats, M).mean(axis=1), lp_fees.reshape(repeats, M).mean(axis=1)
+
+
+# The standard error of the mean over M paths is estimated from the spread between the repeats.
+# The paths ratio is how many times more paths the plain generator needs for the error of QMC,
+# (se_mc / se_qmc)^2, assuming that its error falls as 1 / sqrt(M).
+def main():
+    parser = argparse.ArgumentParser(description="Compare the convergence of the MC and QMC price paths")
+    parser.add_argument("--days", type=float, default=CONVERGENCE_DURATION_DAYS)
+    parser.add_argument("--repeats", type=int, default=CONVERGENCE_REPEATS)
+    parser.add_argument("--liquidity", type=float, default=CONVERGENCE_LIQUIDITY_USD)
+    parser.add_argument("--paths", type=int, nargs="+", default=CONVERGENCE_PATHS)
+    args = parser.parse_args()
+
+    n = int(args.days * 86400 / BLOCK_TIME_SEC)
+    print(f"{'M':>5} {'metric':>8} {'mean mc':>10} {'se mc':>8} {'mean qmc':>10} {'se qmc':>8} {'paths ratio':>11}")
+    for M in args.paths:
+        results = {}
+        for name, generator in GENERATORS.items():
+            np.random.seed(CONVERGENCE_SEED + M)
+            results[name] = sample_means(generator, n, M, args.repeats, args.liquidity)
+        for k, metric in enumerate(("lvr", "lp_fees")):
+            mc, quasi = results["mc"][k], results["qmc"][k]
+            se_mc, se_qmc = mc.std(ddof=1), quasi.std(ddof=1)
+            ratio = (se_mc / se_qmc) ** 2 if se_qmc > 0 else float("inf")
+            print(f"{M:5} {metric:>8} {mc.mean():10.2f} {se_mc:8.3f} {quasi.mean():10.2f} {se_qmc:8.3f} {ratio:11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#
+# This file records the state of the pools during a simulation, every `every` blocks.
+# The values are written into a preallocated array (optionally a `.npy` file
+# mapped to memory) with one row per run, so the time series of many runs
+# can be collected without holding them in RAM.
+#
+
+import numpy as np
+from common import *
+
+############################################################
+
+# the recorded attributes of `DEX` (or `BatchDEX`); the metrics are cumulative
+RECORDED_FIELDS = ("reserve_x", "reserve_y", "lp_fees", "lp_fees_arb", "lvr", "volume", "volume_arb", "num_tx")
+
+# record once per hour by default
+RECORD_EVERY_BLOCKS = 3600 // BLOCK_TIME_SEC
+
+
+class Recorder:
+    def __init__(self, n, num_runs=1, every=RECORD_EVERY_BLOCKS, filename=None):
+        self.n = n
+        self.every = every
+        self.num_points = -(-n // every)
+        # the block after which each point is recorded; the last one is the end of the run
+        self.blocks = np.minimum(np.arange(1, self.num_points + 1) * every, n) - 1
+        shape = (len(RECORDED_FIELDS), num_runs, self.num_points)
+        if filename is None:
+            self.data = np.zeros(shape)
+        else:
+            self.data = np.lib.format.open_memmap(filename, mode="w+", dtype=np.float64, shape=shape)
+
+
+    # the array of shape (num_runs, num_points) of a recorded field
+    def field(self, name):
+        return self.data[RECORDED_FIELDS.index(name)]
+
+
+    def days(self):
+        return (self.blocks + 1) * BLOCK_TIME_SEC / 86400
+
+
+    # records a point of all runs: `dex` is a `BatchDEX` with one pool per run,
+    # or a `DEX` if there is a single run
+    def record(self, point, dex):
+        for k, name in enumerate(RECORDED_FIELDS):
+            self.data[k, :, point] = getattr(dex, name)
+
+
+    # the recorder of a single run, to be passed to `simulation.estimate_performance`
+    def for_run(self, run):
+        return RunRecorder(self, run)
+
+
+    def flush(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+
+
+class RunRecorder:
+    def __init__(self, recorder, run):
+        self.recorder = recorder
+        self.run = run
+        self.every = recorder.every
+
+
+    def record(self, point, dex):
+        data = self.recorder.data
+        for k, name in enumerate(RECORDED_FIELDS):
+            data[k, self.run, point] = getattr(dex, name)
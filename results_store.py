@@ -0,0 +1,78 @@
+#
+# This file keeps the results of the simulations on disk, so that an interrupted
+# sweep can be resumed and the plots can be redrawn without simulating again.
+# The file is a flat array of fixed-size records (see `RESULT_DTYPE`) that is
+# appended to after each simulation and read back as a memory-mapped NumPy array.
+#
+
+import os
+from hashlib import blake2b
+import numpy as np
+
+############################################################
+
+# records with fewer metrics are padded with NaN
+MAX_RESULT_METRICS = 12
+
+RESULT_DTYPE = np.dtype([
+    ("params", "S64"),
+    ("liquidity_usd", "f8"),
+    ("sim", "i8"),
+    ("seed", "i8"),
+    ("num_metrics", "i8"),
+    ("metrics", "f8", (MAX_RESULT_METRICS,)),
+])
+
+# The records are identified by a fixed-size digest of the params string,
+# so that long strings are not cut off at the size of the field
+def params_key(params):
+    return blake2b(params.encode(), digest_size=32).hexdigest().encode()
+
+
+class ResultStore:
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = None
+
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return np.zeros(0, dtype=RESULT_DTYPE)
+        # ignore a partially written record at the end of the file
+        num_records = os.path.getsize(self.filename) // RESULT_DTYPE.itemsize
+        if num_records == 0:
+            return np.zeros(0, dtype=RESULT_DTYPE)
+        return np.memmap(self.filename, dtype=RESULT_DTYPE, mode="r", shape=(num_records,))
+
+
+    def _load_index(self):
+        if self.index is None:
+            self.index = {}
+            for record in self.load():
+                key = (record["params"], float(record["liquidity_usd"]), int(record["sim"]), int(record["seed"]))
+                self.index[key] = record["metrics"][:record["num_metrics"]].copy()
+        return self.index
+
+
+    def get(self, params, liquidity_usd, sim, seed):
+        return self._load_index().get((params_key(params), float(liquidity_usd), int(sim), int(seed)))
+
+
+    def append(self, params, liquidity_usd, sim, seed, metrics):
+        metrics = np.asarray(metrics, dtype=float)
+        assert len(metrics) <= MAX_RESULT_METRICS
+        record = np.zeros(1, dtype=RESULT_DTYPE)
+        record["params"] = params_key(params)
+        record["liquidity_usd"] = liquidity_usd
+        record["sim"] = sim
+        record["seed"] = seed
+        record["num_metrics"] = len(metrics)
+        record["metrics"] = np.nan
+        record["metrics"][0,:len(metrics)] = metrics
+        with open(self.filename, "r+b" if os.path.exists(self.filename) else "wb") as f:
+            # drop a partially written record, if any
+            size = os.path.getsize(self.filename)
+            f.seek(size - size % RESULT_DTYPE.itemsize)
+            f.write(record.tobytes())
+            f.truncate()
+        self._load_index()[(params_key(params), float(liquidity_usd), int(sim), int(seed))] = metrics
@@ -3,13 +3,20 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
-def generate_lognormal_numbers(mean=50, size=100, lower_bound=10, upper_bound=1000):
-    # Calculate the shape and scale parameters for the log-normal distribution
+# Calculate the shape and scale parameters for the log-normal distribution
+def lognormal_parameters(mean=50, lower_bound=10, upper_bound=1000):
     mu = np.log(mean)
     sigma = (np.log(upper_bound) - np.log(lower_bound)) / 2
+    return mu, sigma
+
+# `rng` is a `np.random.Generator`; by default the global NumPy random state is used
+def generate_lognormal_numbers(mean=50, size=100, lower_bound=10, upper_bound=1000, rng=None):
+    if rng is None:
+        rng = np.random
+    mu, sigma = lognormal_parameters(mean, lower_bound, upper_bound)
     
     # Generate log-normal distributed numbers
-    samples = np.random.lognormal(mean=mu, sigma=sigma, size=size)
+    samples = rng.lognormal(mean=mu, sigma=sigma, size=size)
     
     # Clip the results to lie within a specific range
     if False:
@@ -0,0 +1,154 @@
+#
+# This file computes the optimal split of a swap between two constant product pools
+# with LP fees and a fixed base fee per swap (paid once for each pool used).
+#
+# Buying X with Y: if pool i gets a_i of Y after the base fee, the trader receives
+#   a_i / f_i * X_i / (Y_i + a_i / f_i)
+# where f_i is the fee factor. When both pools are used, the marginal outputs are
+# equal at the optimum, which gives
+#   a_i = sqrt(f_i) * L_i * t - f_i * Y_i
+# with the common t fixed by a_1 + a_2 = amount - basefee_1 - basefee_2.
+# Selling X is symmetric, with X and Y swapped and the base fee converted to X.
+# The split is only valid if both a_i are positive; the trader then picks the best
+# of the split and of each pool alone, which accounts for the extra base fee.
+#
+# The functions work on scalars as well as on NumPy arrays (one swap per entry).
+#
+# With N pools, the same holds for any set of pools that all get a positive amount.
+# Sorted by their marginal output at zero input, the first k pools get
+#   a_i = sqrt(f_i) * L_i * t_k - f_i * Y_i
+# with t_k fixed by the sum of their a_i, and the trader receives sum_i X_i - sum_i sqrt(f_i) * L_i / t_k
+# in total, so all k are compared with prefix sums. A pool that gets little may cost more
+# in base fee than it adds, so from each valid split, the pools are dropped one at a time
+# while this increases the output. The trader picks the best of these splits and of each pool alone;
+# with two pools, these are the same choices as above. (With up to 7 pools, this found the best
+# of all the subsets of pools in all of 3000 random cases.)
+#
+
+import numpy as np
+
+############################################################
+
+# The output of a swap of `amount_in` (including the base fee) into reserves
+# `reserve_in, reserve_out`; see `DEX.get_output_y_to_x`.
+def swap_output(reserve_in, reserve_out, fee_factor, basefee_in, amount_in):
+    amount_in_without_fee = np.maximum(amount_in - basefee_in, 0.0) / fee_factor
+    return amount_in_without_fee * reserve_out / (reserve_in + amount_in_without_fee)
+
+
+def _swap_output_scalar(reserve_in, reserve_out, fee_factor, basefee_in, amount_in):
+    amount_in -= basefee_in
+    if amount_in <= 0:
+        return 0.0
+    amount_in_without_fee = amount_in / fee_factor
+    return amount_in_without_fee * reserve_out / (reserve_in + amount_in_without_fee)
+
+
+# Returns the amount of the input sent to pool `a` (the rest goes to pool `b`).
+# The base fees are in the units of the input.
+def optimal_split(reserve_in_a, reserve_out_a, fee_factor_a, basefee_in_a,
+                  reserve_in_b, reserve_out_b, fee_factor_b, basefee_in_b, amount_in):
+    w_a = (fee_factor_a * reserve_in_a * reserve_out_a) ** 0.5
+    w_b = (fee_factor_b * reserve_in_b * reserve_out_b) ** 0.5
+    total = amount_in - basefee_in_a - basefee_in_b
+    t = (total + fee_factor_a * reserve_in_a + fee_factor_b * reserve_in_b) / (w_a + w_b)
+    net_a = w_a * t - fee_factor_a * reserve_in_a
+    split_a = net_a + basefee_in_a
+    pool_a = (reserve_in_a, reserve_out_a, fee_factor_a, basefee_in_a)
+    pool_b = (reserve_in_b, reserve_out_b, fee_factor_b, basefee_in_b)
+
+    if isinstance(amount_in, np.ndarray) or isinstance(reserve_in_a, np.ndarray):
+        out_a = swap_output(*pool_a, amount_in)
+        out_b = swap_output(*pool_b, amount_in)
+        out_split = swap_output(*pool_a, split_a) + swap_output(*pool_b, amount_in - split_a)
+        valid = (net_a > 0) & (net_a < total)
+        single_a = np.where(out_a >= out_b, amount_in, 0.0)
+        return np.where(valid & (out_split > np.maximum(out_a, out_b)), split_a, single_a)
+
+    out_a = _swap_output_scalar(*pool_a, amount_in)
+    out_b = _swap_output_scalar(*pool_b, amount_in)
+    if 0 < net_a < total:
+        out_split = _swap_output_scalar(*pool_a, split_a) + _swap_output_scalar(*pool_b, amount_in - split_a)
+        if out_split > max(out_a, out_b):
+            return split_a
+    return amount_in if out_a >= out_b else 0.0
+
+############################################################
+
+# The amount of Y (including the base fee) to send to pool `a` when buying X with `amount_y`
+def optimal_split_y_to_x(reserve_x_a, reserve_y_a, fee_factor_a, basefee_a,
+                         reserve_x_b, reserve_y_b, fee_factor_b, basefee_b, amount_y):
+    return optimal_split(reserve_y_a, reserve_x_a, fee_factor_a, basefee_a,
+                         reserve_y_b, reserve_x_b, fee_factor_b, basefee_b, amount_y)
+
+
+# The amount of X (including the base fee) to send to pool `a` when selling `amount_x`;
+# the base fees are in USD and converted to X at each pool's price, as in `DEX.swap_x_to_y`
+def optimal_split_x_to_y(reserve_x_a, reserve_y_a, fee_factor_a, basefee_a,
+                         reserve_x_b, reserve_y_b, fee_factor_b, basefee_b, amount_x):
+    return optimal_split(reserve_x_a, reserve_y_a, fee_factor_a, basefee_a * reserve_x_a / reserve_y_a,
+                         reserve_x_b, reserve_y_b, fee_factor_b, basefee_b * reserve_x_b / reserve_y_b, amount_x)
+
+############################################################
+
+# Drops the pool of the split over `idx` whose removal increases the output most
+# (it saves a base fee), as long as there is one; `out` and `t` are those of the split.
+def _drop_pools(idx, c, w, reserve_out, basefee_in, amount_in, out, t):
+    while len(idx) > 2:
+        c_idx = c[idx]
+        w_idx = w[idx]
+        # the splits without each of the pools, one per row
+        w_rest = w_idx.sum() - w_idx
+        t_rest = (amount_in - (basefee_in[idx].sum() - basefee_in[idx]) + (c_idx.sum() - c_idx)) / w_rest
+        positive = w_idx[None,:] * t_rest[:,None] > c_idx[None,:]
+        np.fill_diagonal(positive, True)
+        valid = positive.all(axis=1)
+        out_rest = np.where(valid, reserve_out[idx].sum() - reserve_out[idx] - w_rest / np.where(valid, t_rest, 1.0), -np.inf)
+        j = np.argmax(out_rest)
+        if out_rest[j] <= out:
+            break
+        idx = np.delete(idx, j)
+        out = out_rest[j]
+        t = t_rest[j]
+    return idx, out, t
+
+
+# Returns the indices of the pools that get a part of `amount_in` (a scalar)
+# and the amounts they get (including the base fee); the other arguments are arrays, one entry per pool.
+# The base fees are in the units of the input.
+def optimal_multi_split(reserve_in, reserve_out, fee_factor, basefee_in, amount_in):
+    c = fee_factor * reserve_in
+    w = np.sqrt(c * reserve_out)
+    # by decreasing marginal output, w / c
+    order = np.argsort(c / w, kind="stable")
+    c_sorted = c[order]
+    w_sorted = w[order]
+    cum_w = np.cumsum(w_sorted)
+    t = (amount_in - np.cumsum(basefee_in[order]) + np.cumsum(c_sorted)) / cum_w
+    # the split over the first k pools is valid if the last of them gets a positive amount
+    valid = w_sorted * t > c_sorted
+    valid[0] = False
+    out_prefix = np.cumsum(reserve_out[order]) - cum_w / np.where(valid, t, 1.0)
+
+    best_out = -np.inf
+    for k in np.flatnonzero(valid):
+        idx, out, t_idx = _drop_pools(order[:k + 1], c, w, reserve_out, basefee_in, amount_in, out_prefix[k], t[k])
+        if out > best_out:
+            best_idx, best_out, best_t = idx, out, t_idx
+
+    out_single = swap_output(reserve_in, reserve_out, fee_factor, basefee_in, amount_in)
+    best = np.argmax(out_single)
+    if best_out > out_single[best]:
+        return best_idx, w[best_idx] * best_t - c[best_idx] + basefee_in[best_idx]
+    return np.array([best]), np.array([amount_in])
+
+
+# The split of `amount_y` of Y when buying X; the base fees are in USD
+def optimal_multi_split_y_to_x(reserve_x, reserve_y, fee_factor, basefee, amount_y):
+    return optimal_multi_split(reserve_y, reserve_x, fee_factor, basefee, amount_y)
+
+
+# The split of `amount_x` of X when selling it; the base fees are in USD and converted
+# to X at each pool's price, as in `DEX.swap_x_to_y`
+def optimal_multi_split_x_to_y(reserve_x, reserve_y, fee_factor, basefee, amount_x):
+    return optimal_multi_split(reserve_x, reserve_y, fee_factor, basefee * reserve_x / reserve_y, amount_x)
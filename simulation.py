@@ -1,203 +1,583 @@
 import numpy as np
-from dex import DEX
+from itertools import chain
+from time import perf_counter_ns
+from dex import DEX, INITIAL_NON_ARBITRAGE_REGION
+from profiling import Profile, ProfiledDEX, timer
+from routing import optimal_split_x_to_y, optimal_split_y_to_x
+import kernels
 from common import *
 from rng import generate_lognormal_numbers, approximate_mean
 
 ############################################################
 
-def get_price_paths(n, sigma, mu, M=NUM_SIMULATIONS):
-    St = np.exp((mu - sigma ** 2 / 2) + sigma * np.random.normal(0, 1, size=(M, n-1)).T)
+# The paths are generated in chunks of this many paths, which bounds the size of the temporaries
+PRICE_PATH_CHUNK_SIZE = 8
+
+# Returns an array of shape (n, M) with one price path per column.
+# The array is written in place, chunk by chunk. If `filename` is given,
+# it is a `.npy` file mapped to memory, so the paths do not need to fit in RAM;
+# the file is in Fortran order, so each path is contiguous and each chunk of paths
+# is a contiguous range of the file (in C order, every chunk would touch every page).
+# With `dtype=np.float32` the products are still accumulated in float64,
+# and only the final prices are rounded.
+# With `antithetic=True`, the paths come in antithetic pairs: the paths 2k and 2k + 1
+# use the normal numbers Z and -Z, and their initial prices are mirrored in the
+# non-arbitrage region. M must be even.
+def get_price_paths(n, sigma, mu, M=NUM_SIMULATIONS, dtype=np.float64, filename=None, chunk_size=PRICE_PATH_CHUNK_SIZE,
+                    antithetic=False):
+    if filename is None:
+        St = np.empty((n, M), dtype=dtype)
+    else:
+        St = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=(n, M), fortran_order=True)
+    exact = St.dtype == np.float64
+    if antithetic:
+        assert M % 2 == 0, "antithetic paths come in pairs"
+    num_draws = M // 2 if antithetic else M
+    signs = [1, -1] if antithetic else [1]
+
+    # the random numbers are drawn path by path, same as `np.random.normal(0, 1, size=(M, n-1))`
+    for start in range(0, num_draws, chunk_size):
+        end = min(start + chunk_size, num_draws)
+        normals = np.random.normal(0, 1, size=(end - start, n-1))
+        # the negated copy is made first, as the numbers are then transformed in place
+        for k, sign in reversed(list(enumerate(signs))):
+            increments = normals if sign == 1 else -normals
+            increments *= sigma
+            increments += mu - sigma ** 2 / 2
+            np.exp(increments, out=increments)
+            if not exact:
+                increments.cumprod(axis=1, out=increments)
+            St[1:, len(signs) * start + k:len(signs) * end:len(signs)] = increments.T
+            del increments
+        del normals
 
     # we want the initial prices to be randomly distributed in the pool's non-arbitrage space
-    price_low, price_high = DEX().get_non_arbitrage_region()
-    initial_prices = np.random.uniform(price_low / ETH_PRICE, price_high / ETH_PRICE, M)
-    St = np.vstack([initial_prices, St])
-
-    St = ETH_PRICE * St.cumprod(axis=0)
+    price_low, price_high = INITIAL_NON_ARBITRAGE_REGION
+    initial_prices = np.random.uniform(price_low / ETH_PRICE, price_high / ETH_PRICE, num_draws)
+    if antithetic:
+        mirrored = (price_low / ETH_PRICE + price_high / ETH_PRICE) - initial_prices
+        initial_prices = np.stack([initial_prices, mirrored], axis=1).ravel()
+
+    for start in range(0, M, chunk_size):
+        end = min(start + chunk_size, M)
+        chunk = St[:, start:end]
+        if exact:
+            chunk[0] = initial_prices[start:end]
+            np.cumprod(chunk, axis=0, out=chunk)
+            chunk *= ETH_PRICE
+        else:
+            chunk[0] = 1.0
+            chunk *= ETH_PRICE * initial_prices[start:end]
+
+    if filename is not None:
+        St.flush()
     return St
 
 ############################################################
 
-def estimate_performance(prices, noise_trades=None, liquidity_usd=None):
-    dex = DEX()
+# A price path that is generated block by block while it is being simulated,
+# so the full path is never held in memory. The path is determined by the seed:
+# iterating over the stream again yields exactly the same prices.
+PRICE_STREAM_BLOCK_SIZE = 65536
+
+class PriceStream:
+    def __init__(self, n, sigma, mu, seed=None, block_size=PRICE_STREAM_BLOCK_SIZE):
+        self.n = n
+        self.sigma = sigma
+        self.mu = mu
+        self.seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.block_size = block_size
+
+
+    def __len__(self):
+        return self.n
+
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed)
+        # we want the initial price to be randomly distributed in the pool's non-arbitrage space
+        price_low, price_high = INITIAL_NON_ARBITRAGE_REGION
+        last_price = ETH_PRICE * rng.uniform(price_low / ETH_PRICE, price_high / ETH_PRICE)
+        yield np.array([last_price])
+
+        for start in range(1, self.n, self.block_size):
+            block = rng.standard_normal(min(self.block_size, self.n - start))
+            block *= self.sigma
+            block += self.mu - self.sigma ** 2 / 2
+            np.exp(block, out=block)
+            block.cumprod(out=block)
+            block *= last_price
+            last_price = block[-1]
+            yield block
+
+
+# M independent price streams, the streaming counterpart of `get_price_paths`
+def get_price_streams(n, sigma, mu, M=NUM_SIMULATIONS, seed=None, block_size=PRICE_STREAM_BLOCK_SIZE):
+    seeds = np.random.SeedSequence(seed).spawn(M)
+    return [PriceStream(n, sigma, mu, s, block_size) for s in seeds]
+
+
+# Yields the blocks of prices of either a price path array or a `PriceStream`
+def iter_price_blocks(prices):
+    if isinstance(prices, PriceStream):
+        return iter(prices)
+    return iter([prices])
+
+
+# Yields the prices in segments of `segment_size` blocks (the last one may be shorter),
+# or in the blocks of `iter_price_blocks` if `segment_size` is None.
+# The segments of a price path array are views, not copies.
+def iter_price_segments(prices, segment_size=None):
+    if segment_size is None:
+        yield from iter_price_blocks(prices)
+        return
+    pending = []
+    pending_size = 0
+    for block in iter_price_blocks(prices):
+        block = np.asarray(block)
+        start = 0
+        while start < len(block):
+            end = min(start + segment_size - pending_size, len(block))
+            pending.append(block[start:end])
+            pending_size += end - start
+            start = end
+            if pending_size == segment_size:
+                yield pending[0] if len(pending) == 1 else np.concatenate(pending)
+                pending = []
+                pending_size = 0
+    if pending:
+        yield pending[0] if len(pending) == 1 else np.concatenate(pending)
+
+############################################################
+
+# Without noise trades the pool's state only changes when the CEX price leaves
+# the no-trade region around the DEX price, so instead of visiting every block,
+# jump straight to the next block where the price is outside of that region.
+# The search window grows while the price stays inside, so the cost is
+# proportional to the number of arbitrage trades rather than to the number of blocks.
+# Trades often come in bursts, so the first few blocks are checked one by one.
+NUM_BLOCKS_CHECKED_ONE_BY_ONE = 8
+MIN_SEARCH_WINDOW_BLOCKS = 64
+MAX_SEARCH_WINDOW_BLOCKS = 65536
+
+# `price_list` holds the same prices as Python floats, which are faster to access one by one
+def find_next_outside(prices, price_list, start, price_low, price_high):
+    n = len(prices)
+    for i in range(start, min(start + NUM_BLOCKS_CHECKED_ONE_BY_ONE, n)):
+        p = price_list[i]
+        if p < price_low or p > price_high:
+            return i
+    start += NUM_BLOCKS_CHECKED_ONE_BY_ONE
+    window = MIN_SEARCH_WINDOW_BLOCKS
+    while start < n:
+        end = min(start + window, n)
+        chunk = prices[start:end]
+        outside = np.flatnonzero((chunk < price_low) | (chunk > price_high))
+        if len(outside):
+            return start + outside[0]
+        start = end
+        window = min(2 * window, MAX_SEARCH_WINDOW_BLOCKS)
+    return n
+
+
+def run_arbitrage_only(dex, prices):
+    prices = np.asarray(prices)
+    price_list = prices.tolist()
+    n = len(prices)
+    i = 0
+    while i < n:
+        price_low, price_high = dex.get_no_trade_region()
+        i = find_next_outside(prices, price_list, i, price_low, price_high)
+        if i < n:
+            # the region is conservative, so the trade may still not happen
+            dex.maybe_arbitrage(price_list[i])
+        i += 1
+
+############################################################
+
+# The noise trades are spread evenly over the blocks: trade `k` executes
+# in the first block `i` with `int(i * noise_trades_per_block) >= k`.
+# Returns the block index of each trade (`n` for trades that never execute).
+def get_noise_trade_blocks(num_trades, n):
+    noise_trades_per_block = num_trades / n
+    last_trade_in_block = (np.arange(n) * noise_trades_per_block).astype(np.int64)
+    return np.searchsorted(last_trade_in_block, np.arange(num_trades), side="left")
+
+
+# Precomputes the noise trades that will actually execute, in CSR form:
+# the trades of block `i` are `amounts[offsets[i]:offsets[i + 1]]`.
+# The trades with size above `max_swap` are rejected due to their price impact,
+# and zero-sized trades do nothing, so both are dropped here.
+# The sign of the amount gives the direction: negative amounts are sells of X (in USD).
+def build_trade_schedule(noise_trades, n, max_swap):
+    noise_trades = np.asarray(noise_trades)
+    blocks = get_noise_trade_blocks(len(noise_trades), n)
+    keep = (blocks < n) & (np.abs(noise_trades) <= max_swap) & (noise_trades != 0)
+    offsets = np.searchsorted(blocks[keep], np.arange(n + 1), side="left")
+    return offsets, noise_trades[keep]
+
+############################################################
+
+# The block loop of `estimate_performance` runs either on the `DEX` class ("python")
+# or on the compiled kernels in `kernels.py` ("numba"). The compiled backend
+# falls back to the `DEX` class if Numba is not installed.
+BACKENDS = ("python", "numba")
+simulation_backend = "python"
+
+def set_backend(backend):
+    global simulation_backend
+    assert backend in BACKENDS
+    simulation_backend = backend
+
+
+def use_compiled_backend(backend):
+    if backend is None:
+        backend = simulation_backend
+    return backend == "numba" and kernels.HAVE_NUMBA
+
+
+def run_compiled(dex, prices, noise_trades, max_swap, recorder=None):
+    state = kernels.pool_state_from_dex([dex])
+    segment_size = recorder.every if recorder is not None else None
+    if noise_trades is not None:
+        offsets, amounts = build_trade_schedule(noise_trades, len(prices), max_swap)
+        amounts = amounts.astype(float)
+    first_block = 0
+    for point, segment in enumerate(iter_price_segments(prices, segment_size)):
+        if noise_trades is None:
+            kernels.run_arbitrage_blocks(state, 0, np.asarray(segment))
+        else:
+            kernels.run_blocks(state, 0, np.asarray(segment), first_block, offsets, amounts)
+        first_block += len(segment)
+        if recorder is not None:
+            kernels.pool_state_to_dex(state, [dex])
+            recorder.record(point, dex)
+    kernels.pool_state_to_dex(state, [dex])
+
+############################################################
+
+# The block loop of `estimate_performance` with noise trades, over the blocks
+# `first_block, first_block + 1, ...` with the prices `prices`
+def run_blocks(dex, prices, first_block, offsets, amounts):
+    for i, cex_price in enumerate(np.asarray(prices).tolist(), first_block):
+        # first execute the arbitrage (may include a backrun)
+        dex.maybe_arbitrage(cex_price)
+        # then execute the noise trades
+        for k in range(offsets[i], offsets[i + 1]):
+            trade_amount = amounts[k]
+            if trade_amount < 0:
+                dex.swap_x_to_y(-trade_amount / cex_price)
+            else:
+                dex.swap_y_to_x(trade_amount)
+        # check if backrun can be done in the same block
+        dex.maybe_arbitrage(cex_price, account_lvr=False)
+
+
+# The same as `run_blocks`, but the noise trades of each block are executed in one
+# `DEX.swap_many` call, which applies the runs of consecutive buys as one reserve update.
+# The results match `run_blocks` up to rounding.
+def run_blocks_coalesced(dex, prices, first_block, offsets, amounts):
+    for i, cex_price in enumerate(np.asarray(prices).tolist(), first_block):
+        # first execute the arbitrage (may include a backrun)
+        dex.maybe_arbitrage(cex_price)
+        # then execute the noise trades
+        start = offsets[i]
+        end = offsets[i + 1]
+        if end - start == 1:
+            trade_amount = amounts[start]
+            if trade_amount < 0:
+                dex.swap_x_to_y(-trade_amount / cex_price)
+            else:
+                dex.swap_y_to_x(trade_amount)
+        elif end > start:
+            dex.swap_many(amounts[start:end], cex_price)
+        # check if backrun can be done in the same block
+        dex.maybe_arbitrage(cex_price, account_lvr=False)
+
+
+# With a `recorder` (see `recorder.py`), the state of the pool is recorded every `recorder.every` blocks;
+# the simulation runs in segments of that many blocks, so the block loop itself is unchanged.
+# With `coalesce=True`, the "python" backend executes the noise trades of each block at once
+# (see `run_blocks_coalesced`), which is faster when there are many trades per block.
+# `dex` is the pool to simulate instead of a new `DEX`, e.g. a `concentrated.ConcentratedDEX`
+# with its positions set up; the compiled backend is only used for the `DEX` class.
+# Its liquidity is left as it is, so `liquidity_usd` must not be given with it.
+# With a `profile`, the run goes through `estimate_performance_profiled` on a new pool,
+# which supports none of the other options.
+def estimate_performance(prices, noise_trades=None, liquidity_usd=None, backend=None, profile=None, recorder=None,
+                         coalesce=False, dex=None):
+    if profile is not None:
+        if dex is not None or recorder is not None or coalesce or backend is not None:
+            raise ValueError("profile cannot be combined with dex, recorder, coalesce or backend")
+        return estimate_performance_profiled(prices, noise_trades, liquidity_usd, profile)[0]
+    if dex is not None and liquidity_usd is not None:
+        # `set_liquidity_usd` would replace the positions of the pool
+        raise ValueError("liquidity_usd cannot be combined with dex; set up the liquidity of the pool instead")
+    if dex is None:
+        dex = DEX()
+    elif type(dex) is not DEX:
+        backend = "python"
     if liquidity_usd is not None:
         dex.set_liquidity_usd(liquidity_usd)
     n = len(prices)
+    segment_size = recorder.every if recorder is not None else None
     if noise_trades is None:
-        for p in prices:
-            dex.maybe_arbitrage(p)
+        if use_compiled_backend(backend):
+            run_compiled(dex, prices, None, None, recorder)
+        else:
+            for point, segment in enumerate(iter_price_segments(prices, segment_size)):
+                run_arbitrage_only(dex, segment)
+                if recorder is not None:
+                    recorder.record(point, dex)
     else:
-        noise_trades_per_block = len(noise_trades) / n
-        #print("noise_trades_per_block=", noise_trades_per_block)
         max_swap = swap_size_from_liquidity(dex.liquidity_usd(), MAX_PRICE_IMPACT_PCT / 100)
         print("max swap=", max_swap)
-        last_noise_trade = -1
-        for i in range(n):
-            # first execute the arbitrage (may include a backrun)
-            cex_price = prices[i]
-            dex.maybe_arbitrage(cex_price)
-            # then execute the noise trades
-            k = last_noise_trade + 1
-            next_noise_trade = int(i * noise_trades_per_block)
-            while k <= next_noise_trade:
-                trade_amount = noise_trades[k]
-                if abs(trade_amount) <= max_swap:
-                    if trade_amount < 0:
-                        trade_amount = -trade_amount / cex_price
-                        dex.swap_x_to_y(trade_amount)
-                    elif trade_amount > 0:
-                        dex.swap_y_to_x(trade_amount)
-                k += 1
-            last_noise_trade = next_noise_trade
-            # check if backrun can be done in the same block
-            dex.maybe_arbitrage(cex_price, account_lvr=False)
+        if use_compiled_backend(backend):
+            run_compiled(dex, prices, noise_trades, max_swap, recorder)
+            return dex.lvr, dex.lp_fees, dex.lp_fees_arb, dex.volume, dex.volume_arb
+
+        offsets, amounts = build_trade_schedule(noise_trades, n, max_swap)
+        offsets = offsets.tolist()
+        amounts = amounts.tolist()
+        first_block = 0
+        for point, segment in enumerate(iter_price_segments(prices, segment_size)):
+            if coalesce:
+                run_blocks_coalesced(dex, segment, first_block, offsets, amounts)
+            else:
+                run_blocks(dex, segment, first_block, offsets, amounts)
+            first_block += len(segment)
+            if recorder is not None:
+                recorder.record(point, dex)
 
     return dex.lvr, dex.lp_fees, dex.lp_fees_arb, dex.volume, dex.volume_arb
 
+
+# The same as `estimate_performance` on the `DEX` class, but the counters
+# of the DEX calls and the noise trades and, if enabled, the time of each phase
+# (arbitrage, noise trades, backruns) are added to `profile` (a new `Profile` by default).
+# Kept separate from `estimate_performance` so that the unprofiled loop has no overhead.
+# Returns `(metrics, profile)`.
+def estimate_performance_profiled(prices, noise_trades=None, liquidity_usd=None, profile=None, timing=True):
+    if profile is None:
+        profile = Profile(timing=timing)
+    dex = ProfiledDEX(profile)
+    if liquidity_usd is not None:
+        dex.set_liquidity_usd(liquidity_usd)
+    n = len(prices)
+    profile.count("blocks", n)
+    if noise_trades is None:
+        with timer(profile, "arbitrage"):
+            for block in iter_price_blocks(prices):
+                run_arbitrage_only(dex, block)
+        return (dex.lvr, dex.lp_fees, dex.lp_fees_arb, dex.volume, dex.volume_arb), profile
+
+    max_swap = swap_size_from_liquidity(dex.liquidity_usd(), MAX_PRICE_IMPACT_PCT / 100)
+    with timer(profile, "schedule"):
+        count_noise_trades(profile, noise_trades, n, max_swap)
+        offsets, amounts = build_trade_schedule(noise_trades, n, max_swap)
+    offsets = offsets.tolist()
+    amounts = amounts.tolist()
+    timing = profile.timing
+    time_arbitrage = time_noise = time_backrun = 0
+    for i, cex_price in enumerate(chain.from_iterable(iter_price_blocks(prices))):
+        if timing:
+            t0 = perf_counter_ns()
+        dex.maybe_arbitrage(cex_price)
+        if timing:
+            t1 = perf_counter_ns()
+        for k in range(offsets[i], offsets[i + 1]):
+            trade_amount = amounts[k]
+            if trade_amount < 0:
+                dex.swap_x_to_y(-trade_amount / cex_price)
+            else:
+                dex.swap_y_to_x(trade_amount)
+        if timing:
+            t2 = perf_counter_ns()
+        dex.maybe_arbitrage(cex_price, account_lvr=False)
+        if timing:
+            t3 = perf_counter_ns()
+            time_arbitrage += t1 - t0
+            time_noise += t2 - t1
+            time_backrun += t3 - t2
+    if timing:
+        profile.add_time("arbitrage", time_arbitrage)
+        profile.add_time("noise", time_noise)
+        profile.add_time("backrun", time_backrun)
+
+    return (dex.lvr, dex.lp_fees, dex.lp_fees_arb, dex.volume, dex.volume_arb), profile
+
+
+# Counts what happens to the noise trades before the simulation:
+# trades that never execute (past the last block), are rejected due to their price impact,
+# are zero-sized, or are scheduled.
+def count_noise_trades(profile, noise_trades, n, max_swap):
+    noise_trades = np.asarray(noise_trades)
+    blocks = get_noise_trade_blocks(len(noise_trades), n)
+    in_time = blocks < n
+    too_large = in_time & (np.abs(noise_trades) > max_swap)
+    zero = in_time & (noise_trades == 0)
+    profile.count("noise_trades", len(noise_trades))
+    profile.count("noise_trades_after_last_block", int(np.count_nonzero(~in_time)))
+    profile.count("noise_trades_rejected_by_price_impact", int(np.count_nonzero(too_large)))
+    profile.count("noise_trades_zero", int(np.count_nonzero(zero)))
+    profile.count("noise_trades_scheduled", int(np.count_nonzero(in_time & ~too_large & ~zero)))
+
 ############################################################
 
-#
-# Note: instead of implementing the full & exact routing with gas,
-#   here I use a simpler approach that:
-#   1) for small swaps, simply routes through the best pool alone
-#   2) for larger swaps, split them by liquidity, after equalizing the price
-#
-SMALL_SWAP_SIZE_USD = 10.0
+# Simulates a single price path with the same noise trades at many liquidity levels
+# in one pass, with the same results as `estimate_performance` at each level.
+# The levels share the price reads and the trade schedule: a trade passes the price
+# impact filter at all levels above some liquidity, so with the levels sorted by
+# liquidity it executes on a contiguous range of them. The levels also share the
+# search for the next block where anything can happen: blocks without noise trades
+# where the price is inside the no-trade region of every level are skipped,
+# and in the other blocks only the levels that can trade are visited.
+def estimate_performance_sweep(prices, noise_trades, liquidities):
+    prices = np.asarray(prices)
+    price_list = prices.tolist()
+    n = len(prices)
+    order = sorted(range(len(liquidities)), key=lambda j: liquidities[j])
+    dexes = []
+    for j in order:
+        dex = DEX()
+        dex.set_liquidity_usd(liquidities[j])
+        dexes.append(dex)
+    num_levels = len(dexes)
 
-def route_swap_x_to_y(trade_amount_x, dex_my, dex_other):
-    price = dex_my.price()
-    if trade_amount_x * price <= SMALL_SWAP_SIZE_USD:
-        return route_swap_x_to_y_single_tx(trade_amount_x, dex_my, dex_other)
-
-    # first, swap sufficient amount of x to equalize the price between the pools
-    sp1 = sqrt(price)
-    sp2 = sqrt(dex_other.price())
-    if abs(sp1 - sp2) < 1e-8:
-        # both prices are almost equal, do not bother (avoid numerical errors)
-        delta_x = 0
-        swap_step_amount = 0
-    elif sp1 < sp2:
-        # there are more X in dex_my than dex_other; add X to the other DEX
-        delta_x = dex_other.get_x_amount_to_target_price(sp1)
-        swap_step_amount = min(trade_amount_x, delta_x)
-        dex_other.swap_x_to_y(swap_step_amount)
+    if noise_trades is None:
+        trade_blocks = []
     else:
-        delta_x = dex_my.get_x_amount_to_target_price(sp2)
-        swap_step_amount = min(trade_amount_x, delta_x)
-        dex_my.swap_x_to_y(swap_step_amount)
-
-    assert delta_x >= 0
-
-    trade_amount_x -= swap_step_amount
-    if trade_amount_x > 0:
-        # then, if necessary, divide the remaining swap amounts
-        # proportional to the liquidity in the pools
-        liq_my = dex_my.liquidity()
-        liq_other = dex_other.liquidity()
-        prop_my = liq_my / (liq_my + liq_other)
-        swap_step_amount_my = trade_amount_x * prop_my
-        swap_step_amount_other = trade_amount_x - swap_step_amount_my
-        dex_my.swap_x_to_y(swap_step_amount_my)
-        dex_other.swap_x_to_y(swap_step_amount_other)
+        max_swap = [swap_size_from_liquidity(dex.liquidity_usd(), MAX_PRICE_IMPACT_PCT / 100) for dex in dexes]
+        offsets, amounts = build_trade_schedule(noise_trades, n, max(max_swap))
+        # the first level at which each trade passes the price impact filter
+        first_levels = np.searchsorted(max_swap, np.abs(amounts), side="left").tolist()
+        trade_blocks = np.flatnonzero(np.diff(offsets)).tolist()
+        offsets = offsets.tolist()
+        amounts = amounts.tolist()
+
+    regions = [dex.get_no_trade_region() for dex in dexes]
+    next_trade = 0
+    i = 0
+    while i < n:
+        # the next block where a noise trade happens or any level may be arbitraged
+        price_low = max(region[0] for region in regions)
+        price_high = min(region[1] for region in regions)
+        j = find_next_outside(prices, price_list, i, price_low, price_high)
+        while next_trade < len(trade_blocks) and trade_blocks[next_trade] < i:
+            next_trade += 1
+        if next_trade < len(trade_blocks):
+            j = min(j, trade_blocks[next_trade])
+        if j >= n:
+            break
+
+        # first execute the arbitrage at the levels where it can happen
+        cex_price = price_list[j]
+        changed = [level for level in range(num_levels)
+                   if cex_price < regions[level][0] or cex_price > regions[level][1]]
+        for level in changed:
+            dexes[level].maybe_arbitrage(cex_price)
+
+        if noise_trades is not None:
+            # then execute the noise trades
+            first_changed = num_levels
+            for k in range(offsets[j], offsets[j + 1]):
+                trade_amount = amounts[k]
+                first_changed = min(first_changed, first_levels[k])
+                for level in range(first_levels[k], num_levels):
+                    if trade_amount < 0:
+                        dexes[level].swap_x_to_y(-trade_amount / cex_price)
+                    else:
+                        dexes[level].swap_y_to_x(trade_amount)
+            # check if backrun can be done in the same block
+            changed = sorted(set(changed).union(range(first_changed, num_levels)))
+            for level in changed:
+                dexes[level].maybe_arbitrage(cex_price, account_lvr=False)
 
-############################################################
+        for level in changed:
+            regions[level] = dexes[level].get_no_trade_region()
+        i = j + 1
 
-def route_swap_y_to_x(trade_amount_y, dex_my, dex_other):
-    if trade_amount_y <= SMALL_SWAP_SIZE_USD:
-        return route_swap_y_to_x_single_tx(trade_amount_y, dex_my, dex_other)
-
-    sp1 = sqrt(dex_my.price())
-    sp2 = sqrt(dex_other.price())
-
-    # First, swap sufficient amount of Y to equalize the price between the pools
-    if abs(sp1 - sp2) < 1e-8:
-        # Both prices are almost equal, do not bother (avoid numerical errors)
-        delta_y = 0
-        swap_step_amount = 0
-    elif sp1 < sp2:
-        # There are more X in dex_my than dex_other; remove Y from the other DEX
-        delta_y = dex_my.get_y_amount_to_target_price(sp2)
-        swap_step_amount = min(trade_amount_y, delta_y)
-        dex_my.swap_y_to_x(swap_step_amount)
-    else:
-        delta_y = dex_other.get_y_amount_to_target_price(sp1)
-        swap_step_amount = min(trade_amount_y, delta_y)
-        dex_other.swap_y_to_x(swap_step_amount)
-
-    assert delta_y >= 0
-
-    trade_amount_y -= swap_step_amount
-    if trade_amount_y > 0:
-        # Then, if necessary, divide the remaining swap amounts
-        # proportional to the liquidity in the pools
-        liq_my = dex_my.liquidity()
-        liq_other = dex_other.liquidity()
-        prop_my = liq_my / (liq_my + liq_other)
-        swap_step_amount_my = trade_amount_y * prop_my
-        swap_step_amount_other = trade_amount_y - swap_step_amount_my
-        dex_my.swap_y_to_x(swap_step_amount_my)
-        dex_other.swap_y_to_x(swap_step_amount_other)
+    # back to the order of the input levels
+    results = [None] * num_levels
+    for level, j in enumerate(order):
+        dex = dexes[level]
+        results[j] = (dex.lvr, dex.lp_fees, dex.lp_fees_arb, dex.volume, dex.volume_arb)
+    return tuple(np.array(u) for u in zip(*results))
 
 ############################################################
 
-def route_swap_x_to_y_single_tx(trade_amount_x, dex_my, dex_other):
-    amount_my = dex_my.get_output_x_to_y(trade_amount_x)
-    amount_other = dex_other.get_output_x_to_y(trade_amount_x)
-    if amount_my >= amount_other:
-        dex_my.swap_x_to_y(trade_amount_x)
-    else:
-        dex_other.swap_x_to_y(trade_amount_x)
+# The noise trades are routed optimally between the two pools:
+# see `routing.py` for the split, which takes the LP fees and the base fees into account.
+# This changes the results a lot for small pools. The previous router was a heuristic:
+# swaps of up to $10 went through the pool with the better output alone, and larger swaps
+# first moved the pools to the same price and then split the rest in proportion to their liquidity,
+# so the small pool got a share of every larger swap, also when its LP fee and base fee made that a loss
+# for the trader. Compared to it, the LP fees of the smaller pool (next to a $2M pool, over a 1-day path)
+# drop by about 45-50% at $10k, 15% at $100k and 2% at $1M.
+# `multipool.estimate_performance_multipool` routes between N pools with the same split.
+def route_swap_x_to_y(trade_amount_x, dex_my, dex_other):
+    amount_my = optimal_split_x_to_y(dex_my.reserve_x, dex_my.reserve_y, dex_my.fee_factor, dex_my.basefee_usd,
+                                     dex_other.reserve_x, dex_other.reserve_y, dex_other.fee_factor, dex_other.basefee_usd,
+                                     trade_amount_x)
+    if amount_my > 0:
+        dex_my.swap_x_to_y(amount_my)
+    if amount_my < trade_amount_x:
+        dex_other.swap_x_to_y(trade_amount_x - amount_my)
 
-############################################################
 
-def route_swap_y_to_x_single_tx(trade_amount_y, dex_my, dex_other):
-    amount_my = dex_my.get_output_y_to_x(trade_amount_y)
-    amount_other = dex_other.get_output_y_to_x(trade_amount_y)
-    if amount_my >= amount_other:
-        dex_my.swap_y_to_x(trade_amount_y)
-    else:
-        dex_other.swap_y_to_x(trade_amount_y)
+def route_swap_y_to_x(trade_amount_y, dex_my, dex_other):
+    amount_my = optimal_split_y_to_x(dex_my.reserve_x, dex_my.reserve_y, dex_my.fee_factor, dex_my.basefee_usd,
+                                     dex_other.reserve_x, dex_other.reserve_y, dex_other.fee_factor, dex_other.basefee_usd,
+                                     trade_amount_y)
+    if amount_my > 0:
+        dex_my.swap_y_to_x(amount_my)
+    if amount_my < trade_amount_y:
+        dex_other.swap_y_to_x(trade_amount_y - amount_my)
 
 ############################################################
 
-def estimate_performance_twopools(prices, noise_trades, liquidity_usd):
-    dex_my = DEX()
-    dex_other = DEX()
-    dex_my.set_liquidity_usd(liquidity_usd)
-    dex_other.set_liquidity_usd(OTHER_DEX_LIQUDITY_USD)
+# `dex_my` and `dex_other` are the pools to simulate instead of new `DEX` objects
+# (e.g. `concentrated.ConcentratedDEX`); their liquidity is then left as it is,
+# so `liquidity_usd` must not be given with `dex_my`, as in `estimate_performance`.
+# The split of the swaps uses the virtual reserves of the pools.
+def estimate_performance_twopools(prices, noise_trades, liquidity_usd=None, dex_my=None, dex_other=None):
+    if dex_my is None:
+        dex_my = DEX()
+        if liquidity_usd is not None:
+            dex_my.set_liquidity_usd(liquidity_usd)
+    elif liquidity_usd is not None:
+        # `set_liquidity_usd` would replace the positions of the pool
+        raise ValueError("liquidity_usd cannot be combined with dex_my; set up the liquidity of the pool instead")
+    if dex_other is None:
+        dex_other = DEX()
+        dex_other.set_liquidity_usd(OTHER_DEX_LIQUDITY_USD)
     n = len(prices)
 
-    noise_trades_per_block = len(noise_trades) / n
     max_swap_my = swap_size_from_liquidity(dex_my.liquidity_usd(), MAX_PRICE_IMPACT_PCT / 100)
     max_swap_other = swap_size_from_liquidity(dex_other.liquidity_usd(), MAX_PRICE_IMPACT_PCT / 100)
     max_swap_both = swap_size_from_liquidity(
         dex_my.liquidity_usd() + dex_other.liquidity_usd(), MAX_PRICE_IMPACT_PCT / 100)
     #print("max swap=", max_swap_my, max_swap_other, max_swap_both)
 
-    last_noise_trade = -1
-    for i in range(n):
+    # as a quick approximation of the price impact, use L_cumulative = L1 + L2 for the filter
+    # XXX: this is not 100% correct, because not all swaps are shared by both DEX!
+    offsets, amounts = build_trade_schedule(noise_trades, n, max_swap_both)
+    offsets = offsets.tolist()
+    amounts = amounts.tolist()
+
+    for i, cex_price in enumerate(chain.from_iterable(iter_price_blocks(prices))):
         # first execute the arbitrage (may include a backrun)
-        cex_price = prices[i]
         dex_my.maybe_arbitrage(cex_price)
         dex_other.maybe_arbitrage(cex_price)
         # then execute the noise trades
-        k = last_noise_trade + 1
-        next_noise_trade = int(i * noise_trades_per_block)
-        while k <= next_noise_trade:
-            trade_amount = noise_trades[k]
-
-            # as a quick approximation of the price impact, use L_cumulative = L1 + L2 for the filter
-            # XXX: this is not 100% correct, because not all swaps are shared by both DEX!
-            if abs(trade_amount) <= max_swap_both:
-                if trade_amount < 0:
-                    trade_amount_x = -trade_amount / cex_price
-                    route_swap_x_to_y(trade_amount_x, dex_my, dex_other)
-                else:
-                    trade_amount_y = trade_amount
-                    route_swap_y_to_x(trade_amount_y, dex_my, dex_other)
-
-            k += 1
-        last_noise_trade = next_noise_trade
+        for k in range(offsets[i], offsets[i + 1]):
+            trade_amount = amounts[k]
+            if trade_amount < 0:
+                trade_amount_x = -trade_amount / cex_price
+                route_swap_x_to_y(trade_amount_x, dex_my, dex_other)
+            else:
+                trade_amount_y = trade_amount
+                route_swap_y_to_x(trade_amount_y, dex_my, dex_other)
         # check if backrun can be done in the same block
         dex_my.maybe_arbitrage(cex_price, account_lvr=False)
         dex_other.maybe_arbitrage(cex_price, account_lvr=False)
@@ -207,15 +587,17 @@ def estimate_performance_twopools(prices, noise_trades, liquidity_usd):
 ############################################################
 
 # this is normalized to generate ~1M volume per day
-def generate_trades():
-    swap_sizes = generate_lognormal_numbers(size=int(EXPECTED_VOLUME_PER_DAY * SIMULATION_DURATION_DAYS / approximate_mean()))
+def generate_trades(rng=None, duration_days=SIMULATION_DURATION_DAYS, volume_per_day=EXPECTED_VOLUME_PER_DAY):
+    if rng is None:
+        rng = np.random
+    swap_sizes = generate_lognormal_numbers(size=int(volume_per_day * duration_days / approximate_mean()), rng=rng)
 
     #print("total volume per day=", sum(swap_sizes) / SIMULATION_DURATION_DAYS)
     #print("total fees per day  =", sum(swap_sizes) * 0.05 / 100 / SIMULATION_DURATION_DAYS)
 
     # make half the results negative (determines trade direction)
     n = len(swap_sizes)
-    indices = np.random.permutation(n)
+    indices = rng.permutation(n)
     num_to_invert = n // 2
     swap_sizes[indices[:num_to_invert]] *= -1
     return swap_sizes
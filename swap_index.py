@@ -0,0 +1,28 @@
+#
+# This file answers "how many swaps, and how much volume, are below size S"
+# for any number of thresholds S, after sorting the swap sizes once.
+#
+
+import numpy as np
+
+############################################################
+
+class SwapSizeIndex:
+    def __init__(self, swap_sizes):
+        # the direction of a swap does not matter here, only its size
+        self.sorted_sizes = np.sort(np.abs(swap_sizes))
+        self.cumulative_volume = np.concatenate([[0.0], np.cumsum(self.sorted_sizes)])
+
+
+    def __len__(self):
+        return len(self.sorted_sizes)
+
+
+    # the number of swaps with size < `max_size` (or <= `max_size` if `inclusive`)
+    def count_below(self, max_size, inclusive=False):
+        return np.searchsorted(self.sorted_sizes, max_size, side="right" if inclusive else "left")
+
+
+    # the total size of the swaps with size < `max_size` (or <= `max_size` if `inclusive`)
+    def volume_below(self, max_size, inclusive=False):
+        return self.cumulative_volume[self.count_below(max_size, inclusive)]
@@ -0,0 +1,126 @@
+#
+# This file runs the (liquidity x simulation) grid of an experiment in parallel.
+# The price paths are shared with the worker processes through shared memory,
+# and each simulation index replays the same seeded noise trades at every liquidity level,
+# so the results do not depend on the number of workers.
+#
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from common import *
+from trade_store import TradeStore
+
+############################################################
+
+SWEEP_SEED = 123456
+
+# set in each worker process by `_init_worker`
+_worker_prices = None
+_worker_shm = None
+_worker_trade_store = TradeStore()
+
+
+def _init_worker(shm_name, shape, dtype, trades_dir):
+    global _worker_prices, _worker_shm, _worker_trade_store
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_prices = np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf)
+    _worker_trade_store = TradeStore(directory=trades_dir)
+
+
+def _run_point(simulate, seed, duration_days, liquidity_usd, sim):
+    prices = _worker_prices[:,sim]
+    trades = _worker_trade_store.get(seed, sim, duration_days)
+    return np.array([simulate(prices, trades, liquidity_usd)], dtype=float)
+
+
+# the pools of the levels, level by level, are all the (liquidity, price path) pairs
+def _run_levels(simulate, seed, duration_days, liquidities):
+    num_sims = _worker_prices.shape[1]
+    trades = [_worker_trade_store.get(seed, sim, duration_days) for sim in range(num_sims)]
+    paths = np.tile(np.arange(num_sims), len(liquidities))
+    metrics = simulate(_worker_prices, [trades[sim] for sim in paths], np.repeat(liquidities, num_sims), paths=paths)
+    return np.array(metrics, dtype=float).T
+
+############################################################
+
+# Runs `simulate(prices, trades, liquidity_usd)` for each liquidity level and each
+# column of `all_prices`, and returns an array of shape (len(liquidities), M, k)
+# where k is the number of metrics returned by `simulate`.
+# With `batch=True`, `simulate` runs many pools at once, as `batch.estimate_performance_batch` does:
+# it takes all price paths, the trade set and the liquidity of each pool, and the price path
+# of each pool (`paths`). Each worker then runs `levels_per_task` liquidity levels together;
+# the batched engine is faster with more pools.
+# `simulate` must be a module-level function so that it can be sent to the workers.
+# If `trades_dir` is given, the trade sets are saved there and reused by later sweeps.
+# If `store` (a `results_store.ResultStore`) is given, each result is saved there as soon
+# as it is ready, and the results already in the store are not simulated again.
+# They are identified by `simulate`, the number of blocks and `params`, which should
+# describe anything else that the results depend on (e.g. the price path seed).
+def run_sweep(simulate, all_prices, liquidities, num_workers=NUM_WORKERS, seed=SWEEP_SEED, batch=False,
+              trades_dir=None, store=None, params="", levels_per_task=1):
+    global _worker_prices, _worker_trade_store
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    all_prices = np.ascontiguousarray(all_prices)
+    num_blocks, num_sims = all_prices.shape
+    store_params = f"{simulate.__name__} blocks={num_blocks} {params}".strip()
+    # the trade sets cover the duration of the price paths
+    duration_days = num_blocks * BLOCK_TIME_SEC / 86400
+
+    results = [[None] * num_sims for _ in liquidities]
+    if store is not None:
+        for level, liquidity_usd in enumerate(liquidities):
+            for sim in range(num_sims):
+                results[level][sim] = store.get(store_params, liquidity_usd, sim, seed)
+
+    # each task is (the (level, simulation) points it computes, the arguments of `run_task`)
+    if batch:
+        levels = [level for level in range(len(liquidities)) if any(u is None for u in results[level])]
+        tasks = []
+        for start in range(0, len(levels), levels_per_task):
+            task_levels = levels[start:start + levels_per_task]
+            tasks.append(([(level, sim) for level in task_levels for sim in range(num_sims)],
+                          (np.array([liquidities[level] for level in task_levels], dtype=float),)))
+    else:
+        tasks = [([(level, sim)], (liquidity_usd, sim))
+                 for level, liquidity_usd in enumerate(liquidities) for sim in range(num_sims)
+                 if results[level][sim] is None]
+    run_task = _run_levels if batch else _run_point
+
+    def save(points, task_results):
+        for (level, sim), metrics in zip(points, task_results):
+            # a batch task also recomputes the simulations of its level that are already stored
+            already_stored = results[level][sim] is not None
+            results[level][sim] = metrics
+            if store is not None and not already_stored:
+                store.append(store_params, liquidities[level], sim, seed, metrics)
+
+    if len(tasks) == 0:
+        pass
+    elif num_workers <= 1:
+        _worker_prices = all_prices
+        _worker_trade_store = TradeStore(directory=trades_dir)
+        try:
+            for points, args in tasks:
+                save(points, run_task(simulate, seed, duration_days, *args))
+        finally:
+            _worker_prices = None
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=all_prices.nbytes)
+        try:
+            shared_prices = np.ndarray(all_prices.shape, dtype=all_prices.dtype, buffer=shm.buf)
+            shared_prices[:] = all_prices
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                     initargs=(shm.name, all_prices.shape, all_prices.dtype, trades_dir)) as executor:
+                futures = {executor.submit(run_task, simulate, seed, duration_days, *args): points
+                           for points, args in tasks}
+                for future in as_completed(futures):
+                    save(futures[future], future.result())
+            del shared_prices
+        finally:
+            shm.close()
+            shm.unlink()
+
+    return np.array(results, dtype=float)
@@ -0,0 +1,61 @@
+#
+# This file keeps generated noise trade sets for reuse.
+# Each set is determined by (seed, simulation index, duration, expected volume),
+# so every liquidity level of a sweep replays exactly the same trades.
+#
+
+import os
+import numpy as np
+from collections import OrderedDict
+from common import *
+from simulation import generate_trades
+
+############################################################
+
+# the number of trade sets kept in memory (~14k trades each with the default parameters)
+TRADE_STORE_MAX_SETS = 256
+
+class TradeStore:
+    def __init__(self, max_sets=TRADE_STORE_MAX_SETS, directory=None):
+        self.max_sets = max_sets
+        # if set, the trade sets are also saved there as `.npy` files
+        self.directory = directory
+        self.cache = OrderedDict()
+
+
+    def filename(self, key):
+        seed, sim, duration_days, volume_per_day = key
+        return os.path.join(self.directory, f"trades_{seed}_{sim}_{duration_days:g}_{volume_per_day:g}.npy")
+
+
+    def get(self, seed, sim, duration_days=SIMULATION_DURATION_DAYS, volume_per_day=EXPECTED_VOLUME_PER_DAY):
+        key = (seed, sim, duration_days, volume_per_day)
+        trades = self.cache.get(key)
+        if trades is not None:
+            self.cache.move_to_end(key)
+            return trades
+
+        if self.directory is not None and os.path.exists(self.filename(key)):
+            trades = np.load(self.filename(key))
+        else:
+            rng = np.random.default_rng([seed, sim])
+            trades = generate_trades(rng, duration_days, volume_per_day)
+            if self.directory is not None:
+                self.save(key, trades)
+
+        # the same array is returned to all callers
+        trades.flags.writeable = False
+        self.cache[key] = trades
+        while len(self.cache) > self.max_sets:
+            self.cache.popitem(last=False)
+        return trades
+
+
+    def save(self, key, trades):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.filename(key)
+        # write to a temporary file first, as other processes may be reading the same set
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, "wb") as f:
+            np.save(f, trades)
+        os.replace(tmp_filename, filename)
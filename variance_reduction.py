@@ -0,0 +1,84 @@
+#
+# This file has estimators of the mean LP PnL with a smaller variance than the plain average.
+#
+# Control variate: the analytical LVR-with-fees formula (from the paper) scaled by
+# the price-weighted realized variance of the path, sum_t (P_t / P_0) * r_{t+1}^2.
+# Its expectation is known exactly, and it tracks the realized LVR (in $) of the path;
+# the estimator subtracts the fitted part of its deviation from the expectation.
+#
+# Antithetic paths (`get_price_paths(..., antithetic=True)`) are averaged in pairs
+# before estimating the standard error, since the two paths of a pair are not independent.
+# Note that LVR depends mostly on the squared price moves, which are the same for
+# Z and -Z, so antithetic pairs reduce the variance of the LVR much less than
+# they do for odd functions of the path.
+#
+# Common random numbers: the sweeps use the same price path and trade set
+# (`TradeStore.get(seed, sim)`) for the simulation `sim` at every liquidity level,
+# and for the single pool and the two pool runs, so the differences between
+# the levels and the markets are estimated with less variance than their values.
+#
+
+from math import sqrt
+import numpy as np
+from common import *
+from dex import POOL_FEE_PIPS
+
+############################################################
+
+# this is from the paper, but does not give accurate results
+def lvr_with_fees_formula(sigma_per_block=ETH_VOLATILITY_PER_BLOCK, fee_pips=POOL_FEE_PIPS, block_time=BLOCK_TIME_SEC):
+    gamma = fee_pips / 1e6
+    blocks_per_day = 86400 / block_time
+    result_per_block = (sigma_per_block ** 3) * sqrt(block_time / 2) / (8 * gamma)
+    return result_per_block * blocks_per_day
+
+############################################################
+
+# Returns the array of sum_t (P_t / P_0) * r_{t+1}^2 of each path (column) of `all_prices`,
+# where r is the log return, and its expectation for paths from `get_price_paths(n, sigma, mu)`:
+# the increments are independent of the past, E[P_t / P_0] = exp(mu * t)
+# and E[r^2] = sigma^2 + (mu - sigma^2 / 2)^2.
+def price_weighted_variance(all_prices, sigma=ETH_VOLATILITY_PER_BLOCK, mu=0.0):
+    n, num_paths = all_prices.shape
+    values = np.zeros(num_paths)
+    for sim in range(num_paths):
+        prices = np.asarray(all_prices[:,sim], dtype=float)
+        returns = np.diff(np.log(prices))
+        values[sim] = np.dot(prices[:-1] / prices[0], returns * returns)
+    expected = np.sum(np.exp(mu * np.arange(n - 1))) * (sigma ** 2 + (mu - sigma ** 2 / 2) ** 2)
+    return values, expected
+
+
+# The analytical LP PnL of each path at the given liquidity (the control variate),
+# and its expectation. `variance` is the result of `price_weighted_variance`,
+# which does not depend on the liquidity and can be computed once for all levels.
+def analytical_pnl(all_prices, liquidity_usd, sigma=ETH_VOLATILITY_PER_BLOCK, mu=0.0, variance=None):
+    duration_days = all_prices.shape[0] * BLOCK_TIME_SEC / 86400
+    expected_pnl = -lvr_with_fees_formula(sigma) * liquidity_usd * duration_days
+    values, expected = variance if variance is not None else price_weighted_variance(all_prices, sigma, mu)
+    return expected_pnl * values / expected, expected_pnl
+
+############################################################
+
+def _pairs(values, antithetic):
+    values = np.asarray(values, dtype=float)
+    return values.reshape(-1, 2).mean(axis=1) if antithetic else values
+
+
+# Returns `(mean, standard_error)` of the plain average
+def plain_mean(y, antithetic=False):
+    y = _pairs(y, antithetic)
+    return y.mean(), y.std(ddof=1) / sqrt(len(y))
+
+
+# Returns `(mean, standard_error, beta)` of the control variate estimator
+#   mean(y) - beta * (mean(c) - c_mean)
+# where beta is fitted by least squares.
+def control_variate_mean(y, c, c_mean, antithetic=False):
+    y = _pairs(y, antithetic)
+    c = _pairs(c, antithetic)
+    c_var = c.var(ddof=1)
+    beta = np.cov(y, c)[0, 1] / c_var if c_var > 0 else 0.0
+    adjusted = y - beta * (c - c_mean)
+    # one more degree of freedom is used by beta
+    return adjusted.mean(), adjusted.std(ddof=2) / sqrt(len(y)), beta